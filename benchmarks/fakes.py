@@ -0,0 +1,178 @@
+# In-process fakes of the services used by certmgr: a certificate authority (ACME client), an OCSP responder and a CT log.
+import base64
+import datetime
+import hashlib
+import http.server
+import json
+import threading
+import time
+from typing import List, Tuple
+
+import josepy
+from acme import messages
+from asn1crypto import core, ocsp
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+# CT log id (the hash of its public key)
+CT_LOG_ID = base64.b64encode(hashlib.sha256(b'certmgr benchmark ct log').digest()).decode('ascii')
+
+
+class FakeCA:
+    """Signs certificates for any name."""
+
+    def __init__(self, key=None, certificate: x509.Certificate = None):
+        # certmgr expects an RSA issuer when building OCSP requests
+        self.key = key or rsa.generate_private_key(65537, 2048, default_backend())
+        if not certificate:
+            name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'certmgr benchmark CA')])
+            now = datetime.datetime.utcnow()
+            certificate = (x509.CertificateBuilder()
+                           .subject_name(name).issuer_name(name)
+                           .public_key(self.key.public_key())
+                           .serial_number(x509.random_serial_number())
+                           .not_valid_before(now - datetime.timedelta(days=1))
+                           .not_valid_after(now + datetime.timedelta(days=3650))
+                           .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                           .sign(self.key, hashes.SHA256(), default_backend()))
+        self.certificate = certificate
+
+    @classmethod
+    def load(cls, key_pem: bytes, certificate_pem: bytes) -> 'FakeCA':
+        return cls(serialization.load_pem_private_key(key_pem, None, default_backend()),
+                   x509.load_pem_x509_certificate(certificate_pem, default_backend()))
+
+    def dump(self) -> Tuple[bytes, bytes]:
+        return (self.key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()),
+                self.certificate.public_bytes(serialization.Encoding.PEM))
+
+    def issue(self, public_key, common_name: str, alt_names: List[str], not_after: datetime.datetime) -> x509.Certificate:
+        return (x509.CertificateBuilder()
+                .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)]))
+                .issuer_name(self.certificate.subject)
+                .public_key(public_key)
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(not_after - datetime.timedelta(days=90))
+                .not_valid_after(not_after)
+                .add_extension(x509.SubjectAlternativeName([x509.DNSName(name) for name in alt_names]), critical=False)
+                .sign(self.key, hashes.SHA256(), default_backend()))
+
+
+class FakeNetwork:
+    """The subset of acme.client.ClientNetwork used by certmgr."""
+
+    def __init__(self):
+        self.key = josepy.JWKRSA(key=rsa.generate_private_key(65537, 2048, default_backend()))
+
+
+class FakeAcmeClient:
+    """
+    The subset of acme.client.ClientV2 used by certmgr.
+    Orders are created already authorized, and finalized immediately.
+    """
+
+    def __init__(self, ca: FakeCA, validity: int = 90):
+        self.net = FakeNetwork()
+        self.ca = ca
+        self.validity = datetime.timedelta(days=validity)
+        self.orders = 0
+
+    def new_order(self, csr_pem: bytes) -> messages.OrderResource:
+        self.orders += 1
+        return messages.OrderResource(body=messages.Order(status=messages.STATUS_READY), authorizations=[], csr_pem=csr_pem)
+
+    def finalize_order(self, orderr: messages.OrderResource, deadline: datetime.datetime, fetch_alternative_chains: bool = False) -> messages.OrderResource:
+        csr = x509.load_pem_x509_csr(orderr.csr_pem, default_backend())
+        common_name = csr.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
+        try:
+            alt_names = csr.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(x509.DNSName)
+        except x509.ExtensionNotFound:
+            alt_names = [common_name]
+        certificate = self.ca.issue(csr.public_key(), common_name, alt_names, datetime.datetime.utcnow() + self.validity)
+        fullchain_pem = certificate.public_bytes(serialization.Encoding.PEM) + self.ca.certificate.public_bytes(serialization.Encoding.PEM)
+        return orderr.update(body=orderr.body.update(status=messages.STATUS_VALID), fullchain_pem=fullchain_pem.decode('ascii'),
+                             alternative_fullchains_pem=[])
+
+
+def ocsp_response(request_der: bytes, validity: int = 4) -> bytes:
+    """Return a 'good' (unsigned) response for the first certificate of an OCSP request."""
+    request = ocsp.OCSPRequest.load(request_der)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    responses = [{
+        'cert_id': item['req_cert'],
+        'cert_status': ocsp.CertStatus(name='good', value=core.Null()),
+        'this_update': now,
+        'next_update': now + datetime.timedelta(days=validity),
+    } for item in request['tbs_request']['request_list']]
+    basic = ocsp.BasicOCSPResponse({
+        'tbs_response_data': {
+            'responder_id': ocsp.ResponderId(name='by_key', value=b'\0' * 20),
+            'produced_at': now,
+            'responses': responses,
+        },
+        'signature_algorithm': {'algorithm': 'sha256_rsa'},
+        'signature': b'\0' * 256,
+    })
+    return ocsp.OCSPResponse({
+        'response_status': 'successful',
+        'response_bytes': {'response_type': 'basic_ocsp_response', 'response': basic},
+    }).dump()
+
+
+def sct_response() -> dict:
+    return {
+        'sct_version': 0,
+        'id': CT_LOG_ID,
+        'timestamp': int(time.time() * 1000),
+        'extensions': '',
+        'signature': base64.b64encode(b'\x04\x03\x00\x00').decode('ascii'),
+    }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests += 1
+        if self.path == '/ocsp':
+            self._reply(ocsp_response(body), 'application/ocsp-response')
+        elif self.path == '/ct/v1/add-chain':
+            self._reply(json.dumps(sct_response()).encode('ascii'), 'application/json')
+        else:
+            self.send_error(404)
+
+    def _reply(self, content: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    """OCSP responder (POST /ocsp) and CT log (POST /ct/v1/add-chain) on a local port."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.requests = 0
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-server', daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# End-to-end fleet benchmark.
+#
+# Generate a synthetic certmgr.json and data_dir with N certificates, and run 'certmgr update' against in-process fakes
+# of the ACME service, an OCSP responder and a CT log. Each run is done in a child process and reports the time spent
+# in each update phase, the peak RSS and the number of read/write syscalls.
+#
+# Scenarios:
+#   cold: first run. No inventory, OCSP responses and SCTs are fetched for all certificates.
+#   warm: second run. Nothing to do.
+#
+# usage: python3 benchmarks/fleet.py [--sizes 1,100,1000,10000] [--jobs N] [--renew FRACTION] [--json FILE]
+import argparse
+import collections
+import datetime
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fakes  # noqa: E402
+
+# certmgr still uses the naive datetime properties of cryptography
+warnings.filterwarnings('ignore', message='Properties that return a na')
+
+PHASES = ('process_certificates', 'process_params', 'update_ocsp', 'update_signed_certificate_timestamps', 'apply_changes')
+SCENARIOS = ('cold', 'warm')
+
+KEY_SIZE = 2048
+KEY_CURVE = 'secp384r1'
+
+
+def _write(path: str, content: bytes):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+# ----- Fleet generation
+def generate(fleet_dir: str, count: int, server_url: str, renew: float):
+    """Write certmgr.json and install a key and certificate of each type for `count` certificates."""
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+    from certlib.config import Configuration
+    from certlib.context import CertificateContext
+    from certlib.crypto import Certificate, PrivateKey
+    from certlib.utils import commit_file_transactions
+
+    os.makedirs(fleet_dir)
+    ca = fakes.FakeCA()
+    ca_key_pem, ca_cert_pem = ca.dump()
+    _write(os.path.join(fleet_dir, 'ca.key'), ca_key_pem)
+    _write(os.path.join(fleet_dir, 'ca.pem'), ca_cert_pem)
+    # let certmgr build the full certificates
+    _write(os.path.join(fleet_dir, 'root_cert.rsa.pem'), ca_cert_pem)
+    _write(os.path.join(fleet_dir, 'root_cert.ecdsa.pem'), ca_cert_pem)
+
+    config_path = os.path.join(fleet_dir, 'certmgr.json')
+    with open(config_path, 'w') as f:
+        json.dump({
+            'settings': {
+                'data_dir': os.path.join(fleet_dir, 'data'),
+                'log_file': None,
+                'lock_file': None,
+                'key_size': KEY_SIZE,
+                'key_curve': KEY_CURVE,
+                'dhparam_size': 0,
+                'ecparam_curve': None,
+                'ocsp_responder_urls': [server_url + '/ocsp'],
+                'ct_submit_logs': ['benchmark'],
+            },
+            'ct_logs': {
+                'benchmark': {'url': server_url, 'id': fakes.CT_LOG_ID},
+            },
+            'certificates': [{'name': f'host{i}.example.com', 'alt_names': ['@', f'www.host{i}.example.com']} for i in range(count)],
+        }, f, indent=2)
+
+    # sharing keys does not change the work done by certmgr, and saves a lot of time
+    keys = {
+        'rsa': PrivateKey.from_key(rsa.generate_private_key(65537, KEY_SIZE, default_backend())),
+        'ecdsa': PrivateKey.from_key(ec.generate_private_key(ec.SECP384R1(), default_backend())),
+    }
+    root = Certificate(ca.certificate)
+    config = Configuration.load(config_path)
+    now = datetime.datetime.utcnow()
+    renew_count = int(count * renew)
+    for index, name in enumerate(config.certificate_names()):
+        context = CertificateContext(config.certificate(name)[0], config.data_dir, config.path)
+        # the first certificates are within the renewal window
+        not_after = now + datetime.timedelta(days=10 if index < renew_count else 80)
+        ops = []
+        for item in context:
+            key = keys[item.type]
+            certificate = Certificate(ca.issue(key.key.public_key(), context.common_name, context.alt_names, not_after))
+            item.update(key, certificate, [root])
+            ops += [item.save_key(context.config.fileowner), item.save_key(context.config.fileowner, with_certificate=True),
+                    item.save_certificate(context.config.fileowner), item.save_certificate(context.config.fileowner, root),
+                    item.save_chain(context.config.fileowner)]
+        commit_file_transactions([op for op in ops if op])
+    return config_path
+
+
+# ----- Measured run (child process)
+def _proc_io() -> Dict[str, int]:
+    try:
+        with open('/proc/self/io') as f:
+            return {key: int(value) for key, value in (line.split(':') for line in f)}
+    except OSError:  # not on Linux
+        return {}
+
+
+def run_update(fleet_dir: str, jobs: int) -> dict:
+    from certlib.manager import AcmeManager
+    from certlib.update import UpdateAction
+
+    timings = collections.defaultdict(float)
+    lock = threading.Lock()
+
+    def timed(name, method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with lock:
+                    timings[name] += elapsed
+        return wrapper
+
+    for phase in PHASES:
+        setattr(UpdateAction, phase, timed(phase, getattr(UpdateAction, phase)))
+
+    with open(os.path.join(fleet_dir, 'ca.key'), 'rb') as key, open(os.path.join(fleet_dir, 'ca.pem'), 'rb') as cert:
+        acme_client = fakes.FakeAcmeClient(fakes.FakeCA.load(key.read(), cert.read()))
+    AcmeManager.connect_client = lambda self: acme_client
+
+    sys.argv = ['certmgr', '--quiet', '--no-color', '-c', os.path.join(fleet_dir, 'certmgr.json'), '-j', str(jobs), 'update', '--no-auth']
+    io_start = _proc_io()
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    ok, errors = AcmeManager(ROOT).run()
+    elapsed = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    io = _proc_io()
+
+    return {
+        'ok': len(ok),
+        'errors': len(errors),
+        'orders': acme_client.orders,
+        'total': elapsed,
+        'phases': dict(timings),
+        'cpu': (usage.ru_utime + usage.ru_stime) - (usage_start.ru_utime + usage_start.ru_stime),
+        # kilobytes on Linux, bytes on macOS
+        'max_rss': usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        'read_syscalls': io.get('syscr', 0) - io_start.get('syscr', 0),
+        'write_syscalls': io.get('syscw', 0) - io_start.get('syscw', 0),
+        'context_switches': (usage.ru_nvcsw + usage.ru_nivcsw) - (usage_start.ru_nvcsw + usage_start.ru_nivcsw),
+    }
+
+
+# ----- Driver
+def _child(fleet_dir: str, jobs: int) -> dict:
+    with tempfile.NamedTemporaryFile('r', suffix='.json') as output:
+        subprocess.run([sys.executable, os.path.realpath(__file__), '--child', fleet_dir, '--jobs', str(jobs), '--json', output.name],
+                       check=True)
+        return json.load(output)
+
+
+def _print_header():
+    phases = ''.join(f'{phase[:12]:>13}' for phase in PHASES)
+    print(f'{"certs":>6} {"scenario":8} {"total":>8}{phases} {"orders":>7} {"rss MB":>7} {"reads":>8} {"writes":>8}')
+
+
+def _print_result(count: int, scenario: str, result: dict):
+    phases = ''.join(f'{result["phases"].get(phase, 0):13.3f}' for phase in PHASES)
+    print(f'{count:6} {scenario:8} {result["total"]:8.3f}{phases} {result["orders"]:7} {result["max_rss"] / 1048576:7.1f} '
+          f'{result["read_syscalls"]:8} {result["write_syscalls"]:8}')
+    if result['errors']:
+        print(f'  {result["errors"]} certificates failed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='certmgr fleet benchmark')
+    parser.add_argument('--sizes', default='1,100,1000', help='comma separated list of fleet sizes (default: 1,100,1000)')
+    parser.add_argument('--jobs', type=int, default=1, help='certmgr --jobs value')
+    parser.add_argument('--renew', type=float, default=0.0, help='fraction of the certificates to renew on the first run')
+    parser.add_argument('--keep', action='store_true', help="don't delete the generated fleets")
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_update(args.child, args.jobs)
+        with open(args.json, 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    results = []  # type: List[dict]
+    work_dir = tempfile.mkdtemp(prefix='certmgr-fleet-')
+    try:
+        with fakes.FakeServer() as server:
+            _print_header()
+            for count in (int(size) for size in args.sizes.split(',')):
+                fleet_dir = os.path.join(work_dir, str(count))
+                start = time.perf_counter()
+                generate(fleet_dir, count, server.url, args.renew)
+                print(f'# {count} certificates generated in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+                for scenario in SCENARIOS:
+                    result = _child(fleet_dir, args.jobs)
+                    _print_result(count, scenario, result)
+                    results.append(dict(result, certificates=count, scenario=scenario, jobs=args.jobs))
+    finally:
+        if args.keep:
+            print(f'# fleets kept in {work_dir}', file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if any(result['errors'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
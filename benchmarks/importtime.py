@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Import time regression benchmark.
+#
+# For each subcommand, import what certmgr imports before running it (using python -X importtime),
+# and check the result against a time budget and a list of modules the subcommand must not load.
+#
+# usage: python3 benchmarks/importtime.py [--runs N] [--budget MS] [subcommand ...]
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+SUBCOMMANDS = ('check', 'cleanup', 'verify', 'update', 'auth', 'revoke', 'daemon')
+
+# modules which must only be imported when actually needed
+FORBIDDEN = {
+    'check': ('acme', 'josepy', 'OpenSSL', 'dns', 'requests', 'pkg_resources'),
+    'cleanup': ('acme', 'josepy', 'OpenSSL', 'dns', 'requests', 'pkg_resources'),
+    'verify': ('acme', 'josepy', 'requests', 'pkg_resources'),
+    'update': ('acme', 'josepy', 'OpenSSL', 'dns', 'requests', 'pkg_resources'),
+}
+
+# only the check subcommand has a budget: it is the cheapest useful run
+BUDGET = {'check': 100.0}
+
+_LINE = re.compile(r'^import time:\s+(\d+) \|\s+\d+ \| *(\S+)$')
+
+_SCRIPT = '''
+import certlib.manager as manager
+manager._action_class({name!r})
+'''
+
+_MODULES_SCRIPT = _SCRIPT + '''
+import sys
+print('\\n'.join(sys.modules))
+'''
+
+
+def _importtime(script: str) -> Dict[str, float]:
+    """Return the import time (ms) of each module, excluding its submodules."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                          cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            modules[match.group(2)] = int(match.group(1)) / 1000
+    return modules
+
+
+def measure(name: str) -> Tuple[float, Dict[str, float]]:
+    """Return the total import time (ms) of a subcommand, and the import time of each package."""
+    # ignore modules imported by the interpreter startup (site, encodings, …)
+    startup = _importtime('pass')
+    packages = {}
+    for module, duration in _importtime(_SCRIPT.format(name=name)).items():
+        if module not in startup:
+            package = module.split('.')[0]
+            packages[package] = packages.get(package, 0) + duration
+    return sum(packages.values()), packages
+
+
+def imported(name: str) -> List[str]:
+    proc = subprocess.run([sys.executable, '-c', _MODULES_SCRIPT.format(name=name)],
+                          cwd=ROOT, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return proc.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='certmgr import time benchmark')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs per subcommand (the best one is kept)')
+    parser.add_argument('--budget', type=float, default=None, help='override the check subcommand budget (ms)')
+    parser.add_argument('subcommands', nargs='*', default=SUBCOMMANDS)
+    args = parser.parse_args()
+    if args.budget is not None:
+        BUDGET['check'] = args.budget
+
+    failed = False
+    for name in args.subcommands:
+        best, packages = min((measure(name) for _ in range(max(args.runs, 1))), key=lambda result: result[0])
+        heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:3]
+        print(f'{name:8} {best:8.1f} ms   ' + ', '.join(f'{package} {duration:.1f}' for package, duration in heaviest))
+
+        budget = BUDGET.get(name)
+        if budget is not None and best > budget:
+            print(f'  FAIL: {name} imports take {best:.1f} ms (budget {budget:.0f} ms)')
+            failed = True
+
+        loaded = set(imported(name))
+        for module in FORBIDDEN.get(name, ()):
+            if module in loaded:
+                print(f'  FAIL: {name} imports {module}')
+                failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
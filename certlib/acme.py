@@ -1,23 +1,141 @@
 import json
 import os
 import sys
+import threading
+import time
 import urllib
-from typing import Optional
+from importlib import metadata
+from typing import Optional, Tuple
 from urllib import parse
 
 import josepy
-import pkg_resources
 from acme import client, messages
 
-from . import VERSION
+from . import VERSION, metrics, trace
 from .crypto import PrivateKey
 from .logging import log
 from .utils import (ArchiveAndWriteOperation, ArchiveOperation, WriteOperation, commit_file_transactions, get_key_cipher)
 
+_DIRECTORY_CACHE = 'directory.json'
+_NONCE_POOL = 'nonces.json'
+# servers forget unused nonces after a while. Using an expired nonce costs a badNonce round-trip.
+_NONCE_MAX_AGE = 3600
+_NONCE_POOL_SIZE = 10
+
 
 def _user_agent():
-    acmelib = pkg_resources.get_distribution('acme')
-    return f'certmgr/{VERSION} acme-python/{acmelib.version if acmelib else "0.0.0"}'
+    try:
+        acme_version = metadata.version('acme')
+    except metadata.PackageNotFoundError:
+        acme_version = '0.0.0'
+    return f'certmgr/{VERSION} acme-python/{acme_version}'
+
+
+class _ClientNetwork(client.ClientNetwork):
+    """
+    ClientNetwork that can be shared by concurrent workers (--jobs).
+    Popping a nonce from the pool is not atomic in acme.client, so it is serialized here.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._nonce_lock = threading.Lock()
+        self._nonce_pool = None  # type: Optional[Tuple[str, str]]
+
+    def _get_nonce(self, url, new_nonce_url):
+        with self._nonce_lock:
+            return super()._get_nonce(url, new_nonce_url)
+
+    def _send_request(self, method, url, *args, **kwargs):
+        with metrics.request('acme'), trace.span('acme', 'http', method=method, url=url):
+            return super()._send_request(method, url, *args, **kwargs)
+
+    def load_nonces(self, path: str, directory_url: str):
+        self._nonce_pool = (path, directory_url)
+        pool = _load_json(path)
+        # a nonce can be used only once, so never let an other process use them
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        if not pool or pool.get('url') != directory_url or time.time() - pool.get('saved', 0) > _NONCE_MAX_AGE:
+            return
+        with self._nonce_lock:
+            self._nonces.update(josepy.b64.b64decode(nonce) for nonce in pool.get('nonces', ()))
+        log.debug('Loaded %s nonces', len(self._nonces))
+
+    def save_nonces(self):
+        """Save unused nonces for the next run."""
+        if not self._nonce_pool:
+            return
+        path, directory_url = self._nonce_pool
+        with self._nonce_lock:
+            nonces = list(self._nonces)[:_NONCE_POOL_SIZE]
+            self._nonces.clear()
+        if nonces:
+            _save_json(path, {
+                'url': directory_url,
+                'saved': time.time(),
+                'nonces': [josepy.b64.b64encode(nonce).decode('ascii') for nonce in nonces],
+            })
+
+
+def _load_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.debug("ignoring invalid file '%s': %s", path, str(e))
+        return None
+
+
+def _save_json(path: str, value: dict):
+    tmp_path = path + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning("unable to save '%s': %s", path, str(e))
+
+
+def _fetch_directory(net: client.ClientNetwork, cache_path: str, directory_url: str, ttl: int) -> messages.Directory:
+    cache = _load_json(cache_path)
+    if cache and cache.get('url') != directory_url:
+        cache = None
+
+    now = time.time()
+    if cache and now - cache.get('fetched', 0) < ttl:
+        log.debug("Using cached meta for acme server '%s'", directory_url)
+        return messages.Directory.from_json(dict(cache['directory']))
+
+    headers = {}
+    if cache and cache.get('etag'):
+        headers['If-None-Match'] = cache['etag']
+    if cache and cache.get('last_modified'):
+        headers['If-Modified-Since'] = cache['last_modified']
+
+    log.debug("Fetching meta from acme server '%s'", directory_url)
+    # pylint: disable=protected-access
+    response = net._send_request('GET', directory_url, headers=headers)
+    if cache and response.status_code == 304:
+        log.debug('cached meta not modified')
+    else:
+        response = net._check_response(response, content_type=net.JSON_CONTENT_TYPE)
+        cache = {
+            'url': directory_url,
+            'directory': response.json(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+    # from_json may add default fields to the document
+    directory = messages.Directory.from_json(dict(cache['directory']))
+    cache['fetched'] = now
+    _save_json(cache_path, cache)
+    return directory
 
 
 class _PasswordProvider:
@@ -31,7 +149,8 @@ class _PasswordProvider:
         return self.key_cipher.passphrase if self.key_cipher else None
 
 
-def connect_client(account_dir: str, account: str, directory_url: str, passphrase, archive_dir: Optional[str]) -> client.ClientV2:
+def connect_client(account_dir: str, account: str, directory_url: str, passphrase, archive_dir: Optional[str],
+                   directory_ttl: int = 0) -> client.ClientV2:
     registration = None
     registration_path = os.path.join(account_dir, 'registration.json')
     try:
@@ -96,9 +215,9 @@ def connect_client(account_dir: str, account: str, directory_url: str, passphras
         ops.append(op)
 
     try:
-        net = client.ClientNetwork(josepy.JWKRSA(key=client_key.key), account=registration, user_agent=_user_agent())
-        log.debug("Fetching meta from acme server '%s'", directory_url)
-        directory = messages.Directory.from_json(net.get(directory_url).json())
+        net = _ClientNetwork(josepy.JWKRSA(key=client_key.key), account=registration, user_agent=_user_agent())
+        directory = _fetch_directory(net, os.path.join(account_dir, _DIRECTORY_CACHE), directory_url, directory_ttl)
+        net.load_nonces(os.path.join(account_dir, _NONCE_POOL), directory_url)
         acme_client = client.ClientV2(directory, net)
     except Exception as e:
         log.raise_error("Can't connect to ACME service", cause=e)
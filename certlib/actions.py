@@ -5,25 +5,25 @@ import os
 import shutil
 import stat
 from argparse import Namespace
-from typing import List, Optional
+from typing import List, Optional, TYPE_CHECKING
 
-import OpenSSL
-import josepy
-from acme import client
-
-from .auth import authorize
 from .config import Configuration
 from .context import CertificateContext, CertificateItem
-from .crypto import PrivateKey
 from .logging import log
 from .utils import ArchiveOperation, FileOwner, Hooks, commit_file_transactions, dirmode
-from .verify import verify_certificate_installation
+
+# acme, OpenSSL and dns are slow to import, and are not needed by most actions.
+# Actions import them when they run.
+if TYPE_CHECKING:
+    from acme import client
 
 
 class Action(metaclass=abc.ABCMeta):
     has_acme_client = True
+    uses_inventory = False
+    exports_metrics = False
 
-    def __init__(self, config: Configuration, args: Namespace, contexts: List[CertificateContext], acme_client: Optional[client.ClientV2]):
+    def __init__(self, config: Configuration, args: Namespace, contexts: List[CertificateContext], acme_client: Optional['client.ClientV2']):
         self.config = config
         self.args = args
         self.acme_client = acme_client
@@ -209,6 +209,9 @@ class PruneAction(Action):
 class RevokeAction(Action):
 
     def run(self, context: CertificateContext):
+        import OpenSSL
+        import josepy
+
         log.info("Revoking Certificates")
 
         certificate_count = 0
@@ -247,14 +250,18 @@ class RevokeAction(Action):
 
 class AuthAction(Action):
     def run(self, context: CertificateContext):
+        from .auth import authorize
+
         log.info("Process Authorization")
 
         with log.prefix("  - "):
             # until acme provide a clean way to create an order without using a CSR, we just create a dummy CSR …
+            from .crypto import PrivateKey
+
             key = PrivateKey.create('rsa', 2048)
             csr = key.create_csr(context.common_name, context.alt_names, context.config.ocsp_must_staple)
             # … and remove it from the order afterward
-            order = authorize(csr, context, self.acme_client, Hooks(self.config.hooks))
+            order = authorize(csr, context, self.acme_client, Hooks(self.config.hooks, self.config.int('hooks_concurrency')))
             order.update(csr_pem=None)
 
 
@@ -262,6 +269,8 @@ class VerifyAction(Action):
     has_acme_client = False
 
     def run(self, context: CertificateContext):
+        from .verify import verify_certificate_installation
+
         log.info("Verify certificates")
 
         verify_certificate_installation(context)
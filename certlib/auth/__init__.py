@@ -5,6 +5,8 @@ from .dns import authorize_dns
 from .hook import authorize_hook
 from .http import authorize_http
 from .noop import authorize_noop
+from .plugin import authorize_plugin
+from .tls_alpn import authorize_tls_alpn
 from ..config import AuthType
 from ..context import CertificateContext
 from ..utils import Hooks
@@ -20,3 +22,7 @@ def authorize(csr: x509.CertificateSigningRequest, context: CertificateContext,
         return authorize_dns(csr, context, acme_client, hooks)
     elif auth.type == AuthType.hook:
         return authorize_hook(csr, context, acme_client, hooks)
+    elif auth.type == AuthType.tls_alpn:
+        return authorize_tls_alpn(csr, context, acme_client, hooks)
+    elif auth.type == AuthType.plugin:
+        return authorize_plugin(csr, context, acme_client, hooks)
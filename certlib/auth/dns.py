@@ -1,6 +1,11 @@
-from typing import List, Optional
+import collections
+import os
+import socket
+from typing import Dict, List, Optional, Set, Tuple
 
 import dns
+import dns.message
+import dns.name
 import dns.query
 import dns.tsigkeyring
 import dns.update
@@ -9,6 +14,7 @@ from acme.challenges import DNS01
 from cryptography import x509
 
 from .driver import AcmeAuthDriver
+from .. import metrics, resolver, trace
 from ..config import DnsAuthDef, TsigKey
 from ..context import CertificateContext
 from ..logging import log
@@ -16,25 +22,80 @@ from ..utils import Hooks
 
 
 # -------- DNS Auth
+# discovered zones cache file, in the data directory
+_ZONE_CACHE = 'dns_zones.json'
+
+
+class _Connections:
+    """TCP connections to the DNS servers, reused for all the messages sent to a server."""
+
+    def __init__(self):
+        self._sockets: Dict[Tuple[str, int], socket.socket] = {}
+
+    def _connect(self, server: Tuple[str, int]) -> socket.socket:
+        sock = socket.create_connection(server)
+        # dns.query expects a non blocking socket
+        sock.setblocking(False)
+        self._sockets[server] = sock
+        return sock
+
+    def query(self, message: dns.message.Message, server: Tuple[str, int]) -> dns.message.Message:
+        sock = self._sockets.get(server)
+        if sock:
+            try:
+                return dns.query.tcp(message, server[0], port=server[1], sock=sock)
+            except (OSError, EOFError):
+                # the server closed the connection. Try again using a new one.
+                sock.close()
+        return dns.query.tcp(message, server[0], port=server[1], sock=self._connect(server))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for sock in self._sockets.values():
+            sock.close()
+        self._sockets.clear()
+
+
+def _update(zone: str, key_spec: TsigKey) -> dns.update.Update:
+    keyring = dns.tsigkeyring.from_text({key_spec.id: key_spec.secret})
+    return dns.update.Update(zone, keyring=keyring, keyalgorithm=key_spec.algorithm)
+
 
 class DnsAuthDriver(AcmeAuthDriver):
     challenge_type = 'dns-01'
 
-    def __init__(self, acme_client: client.ClientV2, auth: DnsAuthDef):
+    def __init__(self, acme_client: client.ClientV2, auth: DnsAuthDef, data_dir: str):
         super().__init__(acme_client)
         self.auth = auth
-        self.records = []
+        self.data_dir = data_dir
+        # tuple: key_spec, zone, server, names
+        self.records: List[Tuple[TsigKey, str, Tuple[str, int], List[dns.name.Name]]] = []
 
     def do_authorize(self, authzrs: List[messages.AuthorizationResource], hooks: Hooks):
+        # records are grouped by zone, server and key, and each group is added using a single UPDATE message
+        groups: Dict[Tuple[str, Tuple[str, int], str], Tuple[TsigKey, List[Tuple[dns.name.Name, str]]]] = collections.OrderedDict()
+        challenges: List[Tuple[str, str, str]] = []
         for authzr in authzrs:
             domain_name = authzr.body.identifier.value
             challenge: Optional[DNS01] = self.get_challenge(authzr)
             if not challenge:
                 log.raise_error('[%s] Unsupported dns-01 challenge', domain_name)
-
-            zone = self.auth.zone(domain_name)
-            if not zone:
-                log.raise_error("[%s] DNS zone not specified", domain_name)
+            challenges.append((domain_name, challenge.validation_domain_name(domain_name), challenge.validation(self.acme_client.net.key)))
+
+        delegated = self.delegated_records([record_name for _, record_name, _ in challenges])
+        # lookup the zones which are not configured
+        zones = resolver.find_zones([domain_name for domain_name, record_name, _ in challenges
+                                     if record_name not in delegated and not self.auth.zone(domain_name)],
+                                    self.zone_cache, self.auth.zone_cache_ttl)
+        for domain_name, record_name, validation in challenges:
+            if record_name in delegated:
+                # server and key are the ones of the validation zone
+                record_name, zone = delegated[record_name], self.auth.validation_zone
+                domain_name = zone
+            else:
+                zone = self.auth.zone(domain_name) or zones[domain_name]
 
             server = self.auth.server(domain_name)
             if not server:
@@ -44,7 +105,6 @@ class DnsAuthDriver(AcmeAuthDriver):
             if not key_spec:
                 log.raise_error("[%s] no TSIG key specified", domain_name)
 
-            record_name = challenge.validation_domain_name(domain_name)
             log.debug('add dns record "%s" to %s using key %s', record_name, server, key_spec.id)
 
             # relativize domain_name by stripping zone name
@@ -52,25 +112,33 @@ class DnsAuthDriver(AcmeAuthDriver):
             o = dns.name.from_text(zone)
             rel = n.relativize(o)
 
-            keyring = dns.tsigkeyring.from_text({key_spec.id: key_spec.secret})
-            update = dns.update.Update(zone, keyring=keyring, keyalgorithm=key_spec.algorithm)
-            update.add(rel, 300, dns.rdatatype.TXT, challenge.validation(self.acme_client.net.key))
-            try:
-                response = dns.query.tcp(update, server[0], port=server[1])
-            except Exception as ex:
-                self.cleanup()
-                log.raise_error('Cannot add DNS record', cause=ex)
-                raise  # silence flow analyzer warning
-
-            rcode = response.rcode()
-            if rcode == dns.rcode.NOERROR:
-                log.debug('[%s] successfully added TXT record', domain_name)
-                self.records.append((key_spec, zone, server, rel))  # tuple: key_spec, server, name
-            else:
-                self.cleanup()
-                log.raise_error('[%s] add record return rcode %s', domain_name, dns.rcode.to_text(rcode))
+            _, records = groups.setdefault((zone, server, key_spec.id), (key_spec, []))
+            records.append((rel, validation))
+
+        with _Connections() as connections:
+            for (zone, server, _), (key_spec, records) in groups.items():
+                update = _update(zone, key_spec)
+                for rel, validation in records:
+                    update.add(rel, 300, dns.rdatatype.TXT, validation)
+                try:
+                    with metrics.request('dns'), trace.span('dns_update', 'dns', zone=zone, server=server[0], records=len(records)):
+                        response = connections.query(update, server)
+                except Exception as ex:
+                    self.cleanup()
+                    log.raise_error('[%s] Cannot add DNS records', zone, cause=ex)
+                    raise  # silence flow analyzer warning
+
+                rcode = response.rcode()
+                if rcode == dns.rcode.NOERROR:
+                    log.debug('[%s] successfully added %s TXT records', zone, len(records))
+                    self.records.append((key_spec, zone, server, [rel for rel, _ in records]))
+                else:
+                    self.cleanup()
+                    log.raise_error('[%s] add records return rcode %s', zone, dns.rcode.to_text(rcode))
 
         try:
+            # don't answer the challenges before the CA can see the records
+            self.wait_for_propagation(groups)
             # Process authorizations
             valid_authzr = self.get_authorizations(authzrs, self.auth.retry, self.auth.delay)
         except Exception:
@@ -81,19 +149,68 @@ class DnsAuthDriver(AcmeAuthDriver):
 
         return valid_authzr
 
+    @property
+    def zone_cache(self) -> Optional[str]:
+        if self.auth.zone_cache is None:
+            return os.path.join(self.data_dir, _ZONE_CACHE)
+        return self.auth.zone_cache or None
+
+    def delegated_records(self, record_names: List[str]) -> Dict[str, str]:
+        """Return the records which are aliases of a record in the validation zone (record name -> target)."""
+        if not self.auth.validation_zone:
+            return {}
+        validation_zone = dns.name.from_text(self.auth.validation_zone)
+        delegated = {}
+        for record_name, target in resolver.cname_targets(record_names).items():
+            if not target:
+                log.debug('"%s" is not delegated to the validation zone', record_name)
+            elif not dns.name.from_text(target).is_subdomain(validation_zone):
+                log.warning('"%s" is an alias of "%s", which is not in the validation zone %s', record_name, target, self.auth.validation_zone)
+            else:
+                delegated[record_name] = target
+        return delegated
+
+    def wait_for_propagation(self, groups: Dict[Tuple[str, Tuple[str, int], str], Tuple[TsigKey, List[Tuple[dns.name.Name, str]]]]):
+        if self.auth.propagation_timeout <= 0:
+            return
+
+        expected: Dict[Tuple[Tuple[str, int], str], Set[str]] = collections.defaultdict(set)
+        for (zone, server, _), (_, records) in groups.items():
+            # fallback to the updated server if the zone name servers are unknown
+            servers = self.auth.propagation_servers or resolver.authoritative_servers(zone) or [server]
+            origin = dns.name.from_text(zone)
+            for rel, validation in records:
+                name = rel.derelativize(origin).to_text()
+                for name_server in servers:
+                    expected[(name_server, name)].add(validation)
+
+        log.debug('checking %s records on %s name servers', len({name for _, name in expected}), len({server for server, _ in expected}))
+        with trace.span('propagation', 'dns'):
+            missing = resolver.wait_for_txt(expected, self.auth.propagation_timeout, self.auth.propagation_delay)
+        if missing:
+            for server, name in missing:
+                log.warning('record "%s" not found on %s', name, server[0])
+            log.raise_error('DNS records not propagated after %s seconds', self.auth.propagation_timeout)
+        log.debug('records propagated')
+
     def cleanup(self):
-        for key_spec, zone, server, name in self.records:
-            keyring = dns.tsigkeyring.from_text({key_spec.id: key_spec.secret})
-            update = dns.update.Update(zone, keyring=keyring, keyalgorithm=key_spec.algorithm)
-            update.delete(name)
-            try:
-                log.debug('remove dns record "%s" from %s using key %s', name, server, key_spec.id)
-                response = dns.query.tcp(update, server[0], port=server[1])
-                if response.rcode() != dns.rcode.NOERROR:
-                    log.warning('[%s.%s] DNS record cleanup failed: %s', name, zone, dns.rcode.to_text(response.rcode()))
-            except Exception as ex:
-                log.warning('[%s.%s] DNS record cleanup failed: %s', name, zone, str(ex))
+        records, self.records = self.records, []
+        with _Connections() as connections:
+            for key_spec, zone, server, names in records:
+                update = _update(zone, key_spec)
+                # a domain and its wildcard use the same record name
+                for name in dict.fromkeys(names):
+                    update.delete(name)
+                try:
+                    log.debug('remove %s dns records from %s using key %s', len(names), server, key_spec.id)
+                    with metrics.request('dns'), trace.span('dns_delete', 'dns', zone=zone, server=server[0], records=len(names)):
+                        response = connections.query(update, server)
+                    if response.rcode() != dns.rcode.NOERROR:
+                        log.warning('[%s] DNS records cleanup failed: %s', zone, dns.rcode.to_text(response.rcode()))
+                except Exception as ex:
+                    log.warning('[%s] DNS records cleanup failed: %s', zone, str(ex))
 
 
 def authorize_dns(csr: x509.CertificateSigningRequest, context: CertificateContext, acme_client: client.ClientV2, hooks: Hooks) -> messages.OrderResource:
-    return DnsAuthDriver(acme_client, context.config.auth).authorize(csr, hooks)
+    # the context data directory is the certificate one
+    return DnsAuthDriver(acme_client, context.config.auth, os.path.dirname(context.data_dir)).authorize(csr, hooks)
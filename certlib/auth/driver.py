@@ -1,15 +1,22 @@
 import collections
+import contextvars
 import datetime
-import time
-from typing import Dict, List, NamedTuple, Optional, Type
+import heapq
+import itertools
+from concurrent import futures
+from typing import Dict, List, Optional, Tuple, Type
 
 from acme import challenges, client, messages
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization
 
+from .. import trace
 from ..logging import log
 from ..utils import Hooks
 
+# maximum number of concurrent requests to the ACME service for an order
+_MAX_CONCURRENT_REQUESTS = 10
+
 
 class AuthDriver:
 
@@ -20,7 +27,8 @@ class AuthDriver:
         valid_authzr: List[messages.AuthorizationResource] = []
         pending_authzr: List[messages.AuthorizationResource] = []
 
-        order: messages.OrderResource = self.acme_client.new_order(csr.public_bytes(serialization.Encoding.PEM))
+        with trace.span('new_order', 'acme'):
+            order: messages.OrderResource = self.acme_client.new_order(csr.public_bytes(serialization.Encoding.PEM))
         # collect pending auth resources
         for authzr in order.authorizations:  # type: messages.AuthorizationResource
             domain_name = authzr.body.identifier.value
@@ -38,7 +46,8 @@ class AuthDriver:
             return order
 
         # Setup challenge responses
-        valid_authzr += self.do_authorize(pending_authzr, hooks)
+        with trace.span('authorize', 'acme', domains=[authzr.body.identifier.value for authzr in pending_authzr]):
+            valid_authzr += self.do_authorize(pending_authzr, hooks)
 
         # Not required, but better be a good citizen
         order.update(authorizations=valid_authzr)
@@ -49,11 +58,6 @@ class AuthDriver:
         raise NotImplementedError()
 
 
-class AuthorizationTuple(NamedTuple):
-    datetime: datetime.datetime
-    authorization_resource: messages.AuthorizationResource
-
-
 class AcmeAuthDriver(AuthDriver):
     challenge_type: str
 
@@ -63,57 +67,96 @@ class AcmeAuthDriver(AuthDriver):
                 return challenge
         return None
 
-    def get_authorizations(self, authzrs: List[messages.AuthorizationResource], retry: int, delay: int):
-        # answer challenges
-        for authzr in authzrs:
-            domain_name = authzr.body.identifier.value
-            with log.prefix(f"  [{domain_name}] "):
-                challenge = self.get_challenge(authzr)
-                try:
-                    log.debug('Answering challenge')
+    def _answer_challenge(self, authzr: messages.AuthorizationResource):
+        domain_name = authzr.body.identifier.value
+        with log.prefix(f"  [{domain_name}] "):
+            challenge = self.get_challenge(authzr)
+            try:
+                log.debug('Answering challenge')
+                with trace.span('answer_challenge', 'acme', domain=domain_name):
                     self.acme_client.answer_challenge(challenge, challenge.response(self.acme_client.net.key))
-                except Exception as e:
-                    log.raise_error('Error answering challenge', cause=e)
-
-        # poll for authorizations
-        valid_authzr: List[messages.AuthorizationResource] = []
+            except Exception as e:
+                log.raise_error('Error answering challenge', cause=e)
+
+    def _poll(self, authzr: messages.AuthorizationResource, attempt: int):
+        domain_name = authzr.body.identifier.value
+        with log.prefix(f"  [{domain_name}] "), trace.span('poll', 'acme', domain=domain_name, attempt=attempt):
+            log.debug('Polling')
+            return self.acme_client.poll(authzr)
+
+    def get_authorizations(self, authzrs: List[messages.AuthorizationResource], retry: int, delay: int, answer: bool = True):
+        """Answer the challenges (unless answer is False), and wait for the authorizations to be valid."""
+        if not authzrs:
+            return []
+
+        # Challenges are answered concurrently, then each authorization is polled at its own pace (Retry-After).
+        # Polls are scheduled using a deadline ordered heap, so a slow domain does not delay the other ones.
+        # keyed by URI, as a domain and its wildcard have the same identifier
+        valid_authzr: Dict[str, messages.AuthorizationResource] = {}
         retry_counters: Dict[str, int] = collections.defaultdict(int)
-        pending_authzr = [AuthorizationTuple(datetime.datetime.now(), authzr) for authzr in authzrs]
-        while pending_authzr:
-            when, authzr = pending_authzr.pop(0)
-            domain_name = authzr.body.identifier.value
-            with log.prefix(f"  [{domain_name}] "):
-                now = datetime.datetime.now()
-                if now < when:
-                    seconds = (when - now).seconds
-                    if 0 < seconds:
-                        time.sleep(seconds)
-                        log.debug('Polling')
-                try:
-                    authzr, response = self.acme_client.poll(authzr)
-                    if 200 != response.status_code:
-                        log.warning('%s while waiting for domain challenge', response)
-                        pending_authzr.append(AuthorizationTuple(self.acme_client.retry_after(response, default=delay), authzr))
-                        continue
-                except Exception as e:
-                    log.raise_error('Error polling for authorization', cause=e)
-                    assert False  # help type checker
-
-                retry_counters[domain_name] += 1
-                if messages.STATUS_VALID == authzr.body.status:
-                    valid_authzr.append(authzr)
-                    log.progress('Domain authorized (until %s)', authzr.body.expires)
-                    continue
-                elif messages.STATUS_INVALID == authzr.body.status:
-                    e = self.get_challenge(authzr).error
-                    log.raise_error('Authorization failed : %s', e.detail if e else 'Unknown error')
-                elif messages.STATUS_PENDING == authzr.body.status:
-                    if retry_counters[domain_name] > retry:
-                        log.debug('Max retry reached')
-                        log.raise_error('Authorization timed out')
-                    else:
-                        log.debug('Retrying')
-                        pending_authzr.append(AuthorizationTuple(self.acme_client.retry_after(response, default=delay), authzr))
+        schedule: List[Tuple[datetime.datetime, int, messages.AuthorizationResource]] = []
+        counter = itertools.count()
+        running: Dict[futures.Future, Tuple[bool, messages.AuthorizationResource]] = {}
+
+        with futures.ThreadPoolExecutor(max_workers=min(len(authzrs), _MAX_CONCURRENT_REQUESTS), thread_name_prefix='certmgr-auth') as executor:
+            def submit(answer: bool, authzr: messages.AuthorizationResource):
+                # workers must use the caller log prefix and buffer
+                if answer:
+                    future = executor.submit(contextvars.copy_context().run, self._answer_challenge, authzr)
                 else:
-                    log.raise_error('Unexpected authorization status "%s"', authzr.body.status)
-        return valid_authzr
+                    future = executor.submit(contextvars.copy_context().run, self._poll, authzr, retry_counters[authzr.uri] + 1)
+                running[future] = (answer, authzr)
+
+            try:
+                for authzr in authzrs:
+                    submit(answer, authzr)
+
+                while running or schedule:
+                    now = datetime.datetime.now()
+                    while schedule and schedule[0][0] <= now:
+                        submit(False, heapq.heappop(schedule)[2])
+
+                    timeout = (schedule[0][0] - now).total_seconds() if schedule else None
+                    done, _ = futures.wait(running, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        answer, authzr = running.pop(future)
+                        domain_name = authzr.body.identifier.value
+                        with log.prefix(f"  [{domain_name}] "):
+                            if answer:
+                                future.result()
+                                heapq.heappush(schedule, (datetime.datetime.now(), next(counter), authzr))
+                                continue
+
+                            try:
+                                authzr, response = future.result()
+                            except Exception as e:
+                                log.raise_error('Error polling for authorization', cause=e)
+                                assert False  # help type checker
+
+                            if 200 != response.status_code:
+                                log.warning('%s while waiting for domain challenge', response)
+                                heapq.heappush(schedule, (self.acme_client.retry_after(response, default=delay), next(counter), authzr))
+                                continue
+
+                            retry_counters[authzr.uri] += 1
+                            if messages.STATUS_VALID == authzr.body.status:
+                                valid_authzr[authzr.uri] = authzr
+                                log.progress('Domain authorized (until %s)', authzr.body.expires)
+                            elif messages.STATUS_INVALID == authzr.body.status:
+                                challenge = self.get_challenge(authzr)
+                                e = challenge.error if challenge else None
+                                log.raise_error('Authorization failed : %s', e.detail if e else 'Unknown error')
+                            elif messages.STATUS_PENDING == authzr.body.status:
+                                if retry_counters[authzr.uri] > retry:
+                                    log.debug('Max retry reached')
+                                    log.raise_error('Authorization timed out')
+                                else:
+                                    log.debug('Retrying')
+                                    heapq.heappush(schedule, (self.acme_client.retry_after(response, default=delay), next(counter), authzr))
+                            else:
+                                log.raise_error('Unexpected authorization status "%s"', authzr.body.status)
+            finally:
+                # on failure, don't wait for the requests which are not started yet
+                for future in running:
+                    future.cancel()
+        return [valid_authzr[authzr.uri] for authzr in authzrs]
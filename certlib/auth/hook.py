@@ -1,30 +1,72 @@
-from typing import List
+import contextvars
+import json
+from concurrent import futures
+from typing import Dict, List
 
 from acme import client, messages
 from cryptography import x509
 
-from .driver import AuthDriver
+from .driver import AcmeAuthDriver
+from .. import trace
 from ..config import HookAuthDef
 from ..context import CertificateContext
+from ..logging import log
 from ..utils import Hooks
 
 
-class HookAuthDriver(AuthDriver):
+class HookAuthDriver(AcmeAuthDriver):
 
     def __init__(self, acme_client: client.ClientV2, auth: HookAuthDef, common_name: str):
         super().__init__(acme_client)
         self.auth = auth
         self.common_name = common_name
+        self.challenge_type = auth.challenge
 
     def do_authorize(self, authzrs: List[messages.AuthorizationResource], hooks: Hooks):
-        if self.auth.each_domain:
+        if self.auth.mode == 'each_domain':
             for authzr in authzrs:
                 domain_name = authzr.body.identifier.value
                 # TODO: tweak argument list
                 self.auth.cmd.execute(common_name=domain_name)
-        else:
+        elif self.auth.mode == 'common_name':
             self.auth.cmd.execute(common_name=self.common_name)
-        return authzrs  # FIXME: should update authzrs
+        else:
+            self.publish([self.challenge_fields(authzr) for authzr in authzrs])
+            return self.get_authorizations(authzrs, self.auth.retry, self.auth.delay)
+
+        # the hook answered the challenges
+        return self.get_authorizations(authzrs, self.auth.retry, self.auth.delay, answer=False)
+
+    def challenge_fields(self, authzr: messages.AuthorizationResource) -> Dict[str, str]:
+        domain_name = authzr.body.identifier.value
+        challenge = self.get_challenge(authzr)
+        if not challenge:
+            log.raise_error('[%s] Unsupported %s challenge', domain_name, self.challenge_type)
+        # record: the dns-01 record name
+        record = challenge.chall.validation_domain_name(domain_name) if hasattr(challenge.chall, 'validation_domain_name') else ''
+        return {
+            'domain': domain_name,
+            'token': challenge.chall.encode('token'),
+            'validation': challenge.validation(self.acme_client.net.key),
+            'record': record,
+        }
+
+    def publish(self, challenges: List[Dict[str, str]]):
+        if self.auth.mode == 'batch':
+            # one call with all the challenges, as JSON on the hook standard input
+            data = json.dumps({'common_name': self.common_name, 'challenge': self.challenge_type, 'challenges': challenges})
+            if not self.auth.cmd.execute(stdin=data.encode('utf-8'), common_name=self.common_name):
+                log.raise_error('auth hook failed')
+            return
+
+        with trace.span('auth_hooks', 'hook', challenges=len(challenges)), \
+                futures.ThreadPoolExecutor(max_workers=max(min(len(challenges), self.auth.concurrency), 1),
+                                           thread_name_prefix='certmgr-hook') as executor:
+            results = [executor.submit(contextvars.copy_context().run, self.auth.cmd.execute, common_name=self.common_name, **fields)
+                       for fields in challenges]
+        failed = [fields['domain'] for fields, future in zip(challenges, results) if not future.result()]
+        if failed:
+            log.raise_error('auth hook failed for %s', ', '.join(failed))
 
 
 def authorize_hook(csr: x509.CertificateSigningRequest, context: CertificateContext, acme_client: client.ClientV2, hooks: Hooks) -> messages.OrderResource:
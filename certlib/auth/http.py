@@ -1,15 +1,88 @@
+import collections
+import contextvars
 import os
-from typing import List
+import shutil
+import tempfile
+import threading
+import warnings
+from concurrent import futures
+from typing import Dict, List, Optional, Tuple
 
 from acme import client, messages
 from cryptography import x509
 
 from .driver import AcmeAuthDriver
-from ..config import HttpAuthDef
+from .. import metrics, trace
+from ..config import ChallengeTarget, HttpAuthDef
 from ..context import CertificateContext
 from ..logging import log
 from ..utils import Hooks
 
+_CHALLENGE_PATH = '/.well-known/acme-challenge/'
+# self check requests timeout (in seconds)
+_SELF_CHECK_TIMEOUT = 5
+_MAX_CONCURRENT_REQUESTS = 10
+
+
+class _Responder:
+    """
+    Built-in http server answering the http-01 challenges from memory (auth 'listen' option).
+    Concurrent authorizations share the server listening on a given address, which runs while at least one uses it.
+    """
+    _lock = threading.Lock()
+    _instances = {}  # type: Dict[Tuple[str, int], _Responder]
+
+    def __init__(self, address: Tuple[str, int]):
+        # http.server is only needed by this mode
+        import http.server
+
+        responses = self.responses = {}  # type: Dict[str, str]
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                token = self.path[len(_CHALLENGE_PATH):] if self.path.startswith(_CHALLENGE_PATH) else None
+                validation = responses.get(token)
+                if validation is None:
+                    self.send_error(404)
+                    return
+                body = validation.encode('ascii')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                log.debug('http challenge server: %s - %s', self.address_string(), fmt % args)
+
+        self.address = address
+        self.users = 0
+        try:
+            self.server = http.server.ThreadingHTTPServer((address[0] or '', address[1]), Handler)
+        except OSError as e:
+            log.raise_error('Unable to listen on %s:%s', address[0] or '*', address[1], cause=e)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='certmgr-http', daemon=True).start()
+        log.debug('http challenge server listening on %s:%s', address[0] or '*', address[1])
+
+    @classmethod
+    def acquire(cls, address: Tuple[str, int]) -> '_Responder':
+        with cls._lock:
+            responder = cls._instances.get(address)
+            if responder is None:
+                responder = cls._instances[address] = _Responder(address)
+            responder.users += 1
+            return responder
+
+    def release(self):
+        with self._lock:
+            self.users -= 1
+            if self.users:
+                return
+            del self._instances[self.address]
+        self.server.shutdown()
+        self.server.server_close()
+
 
 # -------- HTTP Auth
 class HttpAuthDriver(AcmeAuthDriver):
@@ -18,52 +91,184 @@ class HttpAuthDriver(AcmeAuthDriver):
     def __init__(self, acme_client: client.ClientV2, auth: HttpAuthDef):
         super().__init__(acme_client)
         self.auth = auth
-        self.challenge_http_responses = {}
+        # domain -> (token, validation)
+        self.challenges = {}  # type: Dict[str, Tuple[str, str]]
+        # tuple: target, challenges (domain, token, validation), staging directory of commands targets
+        self.deployed = []  # type: List[Tuple[ChallengeTarget, List[Tuple[str, str, str]], Optional[str]]]
 
     def do_authorize(self, authzrs: List[messages.AuthorizationResource], hooks: Hooks):
+        if self.auth.listen:
+            return self.serve_authorize(authzrs)
+
+        # the challenges are deployed to each target at once, and the targets are processed concurrently
+        targets = collections.OrderedDict()  # type: Dict[ChallengeTarget, List[Tuple[str, str, str]]]
         for authzr in authzrs:
             domain_name = authzr.body.identifier.value
-            http_challenge_directory = self.auth.challenge_directory(domain_name)
-            if not http_challenge_directory:
+            domain_targets = self.auth.challenge_targets(domain_name)
+            if not domain_targets:
                 log.raise_error("[%s] no http challenge directory specified", domain_name)
             challenge = self.get_challenge(authzr)
             if not challenge:
                 log.raise_error('[%s] Unsupported http-01 challenge', domain_name)
-            challenge_file_path = os.path.join(http_challenge_directory, challenge.chall.encode('token'))
-            log.debug('writing http acme-challenge for "%s" in file "%s"', domain_name, challenge_file_path)
-            try:
-                os.makedirs(os.path.dirname(challenge_file_path), 0o755, exist_ok=True)
-                with open(challenge_file_path, 'w') as f:
-                    f.write(challenge.validation(self.acme_client.net.key))
-                    os.fchmod(f.fileno(), 0o644)
-
-                self.challenge_http_responses[domain_name] = challenge_file_path
-                hooks.add('set_http_challenge', domain=domain_name, file=challenge_file_path)
-            except Exception as e:
-                # remove already saved challenges
-                self.abort()
-                log.raise_error('[%s] Unable to create acme-challenge file "%s"', domain_name, challenge_file_path, cause=e)
+            token, validation = challenge.chall.encode('token'), challenge.validation(self.acme_client.net.key)
+            self.challenges[domain_name] = (token, validation)
+            for target in domain_targets:
+                targets.setdefault(target, []).append((domain_name, token, validation))
+
+        try:
+            self._run_all(self._deploy, list(targets.items()))
+        except Exception:
+            # remove already saved challenges
+            self.cleanup()
+            raise
+
+        for target, challenges in targets.items():
+            if isinstance(target, str):
+                for domain_name, token, _ in challenges:
+                    hooks.add('set_http_challenge', domain=domain_name, file=os.path.join(target, token))
 
         try:
             hooks.call()
+            self.self_check()
             # Process authorizations
             valid_authzr = self.get_authorizations(authzrs, self.auth.retry, self.auth.delay)
         except Exception:
-            self.abort()
+            self.cleanup()
             raise
 
-        for domain_name, challenge_file in self.challenge_http_responses.items():
-            log.debug('deleting http acme-challenge for %s', domain_name)
-            os.remove(challenge_file)
-            hooks.add('clear_http_challenge', domain=domain_name, file=challenge_file)
+        self.cleanup()
+        for target, challenges in targets.items():
+            if isinstance(target, str):
+                for domain_name, token, _ in challenges:
+                    hooks.add('clear_http_challenge', domain=domain_name, file=os.path.join(target, token))
         hooks.call()
 
         return valid_authzr
 
-    def abort(self):
-        for challenge_file in self.challenge_http_responses.values():
-            # FIXME: ignore error ?
-            os.remove(challenge_file)
+    @staticmethod
+    def _run_all(func, items: List[tuple]):
+        """Call func for each item concurrently, and raise the first error once all calls are done."""
+        if not items:
+            return
+        with futures.ThreadPoolExecutor(max_workers=min(len(items), _MAX_CONCURRENT_REQUESTS),
+                                        thread_name_prefix='certmgr-http') as executor:
+            results = [executor.submit(contextvars.copy_context().run, func, *item) for item in items]
+        for future in results:
+            future.result()
+
+    @staticmethod
+    def _write_challenges(directory: str, challenges: List[Tuple[str, str, str]]):
+        os.makedirs(directory, 0o755, exist_ok=True)
+        for domain_name, token, validation in challenges:
+            challenge_file_path = os.path.join(directory, token)
+            log.debug('writing http acme-challenge for "%s" in file "%s"', domain_name, challenge_file_path)
+            with open(challenge_file_path, 'w') as f:
+                f.write(validation)
+                os.fchmod(f.fileno(), 0o644)
+
+    def _deploy(self, target: ChallengeTarget, challenges: List[Tuple[str, str, str]]):
+        if isinstance(target, str):
+            self.deployed.append((target, challenges, None))
+            with trace.span('deploy', 'http', target=target, challenges=len(challenges)):
+                try:
+                    self._write_challenges(target, challenges)
+                except OSError as e:
+                    log.raise_error('Unable to create acme-challenge files in "%s"', target, cause=e)
+            return
+
+        # commands get the challenges files in a staging directory
+        staging = tempfile.mkdtemp(prefix='certmgr-challenges-')
+        self.deployed.append((target, challenges, staging))
+        with trace.span('deploy', 'http', target=target.deploy.name, challenges=len(challenges)):
+            try:
+                os.chmod(staging, 0o755)
+                self._write_challenges(staging, challenges)
+            except OSError as e:
+                log.raise_error('Unable to create acme-challenge files in "%s"', staging, cause=e)
+            if not target.deploy.execute(directory=staging, tokens=' '.join(token for _, token, _ in challenges)):
+                log.raise_error('Unable to deploy acme-challenge files using %s', target.deploy.args)
+
+    @staticmethod
+    def _clear(target: ChallengeTarget, challenges: List[Tuple[str, str, str]], staging: Optional[str]):
+        if isinstance(target, str):
+            for domain_name, token, _ in challenges:
+                log.debug('deleting http acme-challenge for %s', domain_name)
+                try:
+                    os.remove(os.path.join(target, token))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    log.warning('[%s] Unable to delete acme-challenge file: %s', domain_name, str(e))
+            return
+
+        if target.clear:
+            # failures are logged by the hook
+            target.clear.execute(directory=staging, tokens=' '.join(token for _, token, _ in challenges))
+        shutil.rmtree(staging, ignore_errors=True)
+
+    def cleanup(self):
+        deployed, self.deployed = self.deployed, []
+        self._run_all(self._clear, deployed)
+
+    def serve_authorize(self, authzrs: List[messages.AuthorizationResource]):
+        # the challenges are served for the lifetime of the authorizations, without files nor hooks
+        for authzr in authzrs:
+            domain_name = authzr.body.identifier.value
+            challenge = self.get_challenge(authzr)
+            if not challenge:
+                log.raise_error('[%s] Unsupported http-01 challenge', domain_name)
+            log.debug('serving http acme-challenge for "%s"', domain_name)
+            self.challenges[domain_name] = (challenge.chall.encode('token'), challenge.validation(self.acme_client.net.key))
+
+        tokens = dict(self.challenges.values())
+        responder = _Responder.acquire(self.auth.listen)
+        responder.responses.update(tokens)
+        try:
+            self.self_check()
+            return self.get_authorizations(authzrs, self.auth.retry, self.auth.delay)
+        finally:
+            for token in tokens:
+                responder.responses.pop(token, None)
+            responder.release()
+
+    def self_check(self):
+        """Fetch the challenges the way the CA does, and fail before answering them if one is not served."""
+        if not self.auth.self_check or not self.challenges:
+            return
+        import requests  # slow to import, and only needed here
+        from urllib3.exceptions import InsecureRequestWarning
+
+        def fetch(domain_name: str, token: str, validation: str) -> Optional[str]:
+            url = f'http://{domain_name}{_CHALLENGE_PATH}{token}'
+            try:
+                with metrics.request('http'):
+                    # like the CA, follow the redirects to https without checking the certificate
+                    response = requests.get(url, timeout=_SELF_CHECK_TIMEOUT, verify=False)
+            except requests.RequestException as e:
+                return str(e) or e.__class__.__name__
+            if response.status_code != requests.codes.ok:
+                return f'HTTP status {response.status_code}'
+            if response.text.strip() != validation:
+                return 'unexpected content'
+            return None
+
+        with trace.span('self_check', 'http', domains=len(self.challenges)), warnings.catch_warnings(), \
+                futures.ThreadPoolExecutor(max_workers=min(len(self.challenges), _MAX_CONCURRENT_REQUESTS),
+                                           thread_name_prefix='certmgr-http') as executor:
+            warnings.simplefilter('ignore', InsecureRequestWarning)
+            checks = {domain_name: executor.submit(contextvars.copy_context().run, fetch, domain_name, token, validation)
+                      for domain_name, (token, validation) in self.challenges.items()}
+            errors = {domain_name: future.result() for domain_name, future in checks.items()}
+
+        for domain_name, error in errors.items():
+            if error:
+                log.warning('[%s] http challenge self check failed: %s', domain_name, error)
+            else:
+                log.debug('[%s] http challenge self check succeeded', domain_name)
+        failed = [domain_name for domain_name, error in errors.items() if error]
+        if failed:
+            log.raise_error('http challenge self check failed for %s of %s domains: %s', len(failed), len(errors), ', '.join(failed))
+        log.info('http challenge self check succeeded for %s domains', len(errors))
 
 
 def authorize_http(csr: x509.CertificateSigningRequest, context: CertificateContext, acme_client: client.ClientV2, hooks: Hooks) -> messages.OrderResource:
@@ -0,0 +1,16 @@
+from acme import client, messages
+from cryptography import x509
+
+from .driver import AuthDriver
+from ..context import CertificateContext
+from ..logging import log
+from ..utils import Hooks, load_plugin
+
+
+def authorize_plugin(csr: x509.CertificateSigningRequest, context: CertificateContext, acme_client: client.ClientV2, hooks: Hooks) -> messages.OrderResource:
+    auth = context.config.auth
+    # the driver class is loaded once, so it can share sessions and credentials between its instances
+    driver = load_plugin(auth.driver, 'certmgr.auth')
+    if not isinstance(driver, type) or not issubclass(driver, AuthDriver):
+        log.raise_error('[plugin:%s] auth driver must be an AuthDriver subclass', auth.driver)
+    return driver(acme_client, auth).authorize(csr, hooks)
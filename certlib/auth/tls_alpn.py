@@ -0,0 +1,164 @@
+import datetime
+import hashlib
+import threading
+from typing import Dict, List, Tuple
+
+from acme import client, messages
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from .driver import AcmeAuthDriver
+from ..config import TlsAlpnAuthDef
+from ..context import CertificateContext
+from ..logging import log
+from ..utils import Hooks
+
+# RFC 8737
+_ACME_TLS_1_PROTOCOL = b'acme-tls/1'
+_ID_PE_ACME_IDENTIFIER = x509.ObjectIdentifier('1.3.6.1.5.5.7.1.31')
+
+
+def _validation_certificate(domain_name: str, key_authorization: str, key: ec.EllipticCurvePrivateKey) -> x509.Certificate:
+    """Return the self-signed certificate answering the tls-alpn-01 challenge of domain_name."""
+    digest = hashlib.sha256(key_authorization.encode('utf-8')).digest()
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain_name)])
+    now = datetime.datetime.utcnow()
+    builder = x509.CertificateBuilder() \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(days=1)) \
+        .not_valid_after(now + datetime.timedelta(days=7)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(domain_name)]), critical=False) \
+        .add_extension(x509.UnrecognizedExtension(_ID_PE_ACME_IDENTIFIER, b'\x04\x20' + digest), critical=True)  # DER OCTET STRING
+    return builder.sign(key, hashes.SHA256(), default_backend())
+
+
+class _Responder:
+    """
+    TLS server presenting the tls-alpn-01 validation certificates, selected using the SNI of the connections.
+    Concurrent authorizations share the server listening on a given address, which runs while at least one uses it.
+    """
+    _lock = threading.Lock()
+    _instances = {}  # type: Dict[Tuple[str, int], _Responder]
+
+    def __init__(self, address: Tuple[str, int]):
+        # pyOpenSSL and socketserver are only needed by this auth
+        import socketserver
+        from OpenSSL import SSL
+
+        self.contexts = {}  # type: Dict[str, SSL.Context]
+        responder = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                connection = SSL.Connection(responder.context, self.request)
+                connection.set_accept_state()
+                try:
+                    # the validation only requires the handshake
+                    connection.do_handshake()
+                    connection.shutdown()
+                except SSL.Error as e:
+                    log.debug('tls-alpn challenge server: %s - handshake failed: %s', self.client_address[0], e)
+
+        class Server(socketserver.ThreadingTCPServer):
+            # the server may be restarted for each authorizations batch
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.context = self._context()
+        self.context.set_tlsext_servername_callback(self._select_context)
+        self.address = address
+        self.users = 0
+        try:
+            self.server = Server((address[0] or '', address[1]), Handler)
+        except OSError as e:
+            log.raise_error('Unable to listen on %s:%s', address[0] or '*', address[1], cause=e)
+        threading.Thread(target=self.server.serve_forever, name='certmgr-tls-alpn', daemon=True).start()
+        log.debug('tls-alpn challenge server listening on %s:%s', address[0] or '*', address[1])
+
+    def _context(self):
+        from OpenSSL import SSL
+
+        context = SSL.Context(SSL.SSLv23_METHOD)
+        context.set_alpn_select_callback(self._select_protocol)
+        return context
+
+    def _select_context(self, connection):
+        server_name = (connection.get_servername() or b'').decode('ascii', 'replace').lower()
+        context = self.contexts.get(server_name)
+        log.debug('tls-alpn challenge server: certificate requested for "%s"', server_name)
+        if context is not None:
+            connection.set_context(context)
+
+    def _select_protocol(self, connection, protocols: List[bytes]) -> bytes:
+        # an empty value rejects the connection
+        return _ACME_TLS_1_PROTOCOL if _ACME_TLS_1_PROTOCOL in protocols else b''
+
+    def add(self, domain_name: str, certificate: x509.Certificate, key: ec.EllipticCurvePrivateKey):
+        from OpenSSL import crypto
+
+        context = self._context()
+        context.use_privatekey(crypto.PKey.from_cryptography_key(key))
+        context.use_certificate(crypto.X509.from_cryptography(certificate))
+        self.contexts[domain_name.lower()] = context
+
+    def remove(self, domain_name: str):
+        self.contexts.pop(domain_name.lower(), None)
+
+    @classmethod
+    def acquire(cls, address: Tuple[str, int]) -> '_Responder':
+        with cls._lock:
+            responder = cls._instances.get(address)
+            if responder is None:
+                responder = cls._instances[address] = _Responder(address)
+            responder.users += 1
+            return responder
+
+    def release(self):
+        with self._lock:
+            self.users -= 1
+            if self.users:
+                return
+            del self._instances[self.address]
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# -------- TLS-ALPN Auth
+class TlsAlpnAuthDriver(AcmeAuthDriver):
+    challenge_type = 'tls-alpn-01'
+
+    def __init__(self, acme_client: client.ClientV2, auth: TlsAlpnAuthDef):
+        super().__init__(acme_client)
+        self.auth = auth
+
+    def do_authorize(self, authzrs: List[messages.AuthorizationResource], hooks: Hooks):
+        # the validation certificates are only used for the handshake, so they all share a single (fast to generate) key
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        certificates = {}  # type: Dict[str, x509.Certificate]
+        for authzr in authzrs:
+            domain_name = authzr.body.identifier.value
+            challenge = self.get_challenge(authzr)
+            if not challenge:
+                log.raise_error('[%s] Unsupported tls-alpn-01 challenge', domain_name)
+            log.debug('serving tls-alpn acme-challenge for "%s"', domain_name)
+            certificates[domain_name] = _validation_certificate(domain_name, challenge.chall.key_authorization(self.acme_client.net.key), key)
+
+        responder = _Responder.acquire(self.auth.listen)
+        for domain_name, certificate in certificates.items():
+            responder.add(domain_name, certificate, key)
+        try:
+            return self.get_authorizations(authzrs, self.auth.retry, self.auth.delay)
+        finally:
+            for domain_name in certificates:
+                responder.remove(domain_name)
+            responder.release()
+
+
+def authorize_tls_alpn(csr: x509.CertificateSigningRequest, context: CertificateContext, acme_client: client.ClientV2, hooks: Hooks) -> messages.OrderResource:
+    return TlsAlpnAuthDriver(acme_client, context.config.auth).authorize(csr, hooks)
@@ -30,7 +30,7 @@ def _get_bool(config: dict, key: str, default: bool = False) -> bool:
 
 def _get_list(config: dict, key: str, default: Optional[Iterable] = None) -> Iterable:
     value = config.get(key, default)
-    return value if (isinstance(value, collections.Iterable) and not isinstance(value, str)) else [] if (
+    return value if (isinstance(value, collections.abc.Iterable) and not isinstance(value, str)) else [] if (
             value is None) else [value]
 
 
@@ -107,11 +107,60 @@ class VerifyDef:
             self.targets = []
 
 
+class ServiceProbe:
+    """Check telling when a reloaded service is ready: a TCP/TLS connection to a port, or a command."""
+    __slots__ = ('host', 'port', 'tls', 'starttls', 'command', 'timeout', 'delay')
+
+    def __init__(self, service_name: str, spec):
+        _check(f"services:{service_name}:ready", {'host', 'port', 'tls', 'starttls', 'command', 'timeout', 'delay'}, spec)
+        self.command = spec.get('command')  # type: Optional[str]
+        self.host = spec.get('host', 'localhost')  # type: str
+        self.port = _get_int(spec, 'port', 0)
+        if bool(self.command) == bool(self.port):
+            log.raise_error('[%s] readiness probe requires either a port or a command', service_name)
+        # tls: the service must serve the certificates installed by this run
+        self.tls = _get_bool(spec, 'tls', True)
+        self.starttls = spec.get('starttls')  # type: Optional[str]
+        # timeout: maximum number of seconds to wait for the service
+        self.timeout = _get_int(spec, 'timeout', 60)
+        # delay: number of seconds between two attempts
+        self.delay = float(spec.get('delay', 1))
+
+
+class ServiceDef:
+    __slots__ = ('name', 'command', 'timeout', 'delay', 'ready')
+
+    def __init__(self, name: str, spec):
+        self.name = name
+        self.ready = None  # type: Optional[ServiceProbe]
+        # seconds given to the service to reload when it has no readiness probe
+        self.delay = 5
+        if isinstance(spec, str):
+            self.command = spec
+            self.timeout = 120
+        elif isinstance(spec, dict):
+            _check(f"services:{name}", {'command', 'timeout', 'delay', 'ready'}, spec)
+            self.command = spec.get('command')
+            self.timeout = _get_int(spec, 'timeout', 120)
+            self.delay = _get_int(spec, 'delay', self.delay)
+            ready = spec.get('ready')
+            if ready:
+                if not isinstance(ready, dict):
+                    log.raise_error('[%s] readiness probe must be a dictionary', name)
+                self.ready = ServiceProbe(name, ready)
+        else:
+            log.raise_error('[%s] service must be either a command line string, or a dictionary', name)
+        if not self.command:
+            log.raise_error('[%s] service command must not be empty', name)
+
+
 class AuthType(Enum):
     noop = 0
     dns = 1
     http = 2
     hook = 3
+    tls_alpn = 4
+    plugin = 5
 
 
 class AuthDef:
@@ -127,47 +176,103 @@ class AuthDef:
         if ty == 'noop':
             return NoAuthDef()
         if ty == 'http':
-            return HttpAuthDef(spec, default if default and default.type == 'http' else None)
+            return HttpAuthDef(spec, default if default and default.type == AuthType.http else None)
         if ty == 'dns':
-            return DnsAuthDef(spec, default if default and default.type == 'dns' else None)
+            return DnsAuthDef(spec, default if default and default.type == AuthType.dns else None)
         if ty == 'hook':
-            return HookAuthDef(spec, default if default and default.type == 'hook' else None)
-        log.raise_error('auth: key type must be one of "noop", "http", "dns", or "hook".')
+            return HookAuthDef(spec, default if default and default.type == AuthType.hook else None)
+        if ty == 'tls-alpn':
+            return TlsAlpnAuthDef(spec, default if default and default.type == AuthType.tls_alpn else None)
+        if ty == 'plugin':
+            return PluginAuthDef(spec, default if default and default.type == AuthType.plugin else None)
+        log.raise_error('auth: key type must be one of "noop", "http", "dns", "tls-alpn", "hook" or "plugin".')
 
 
 class NoAuthDef(AuthDef):
     type = AuthType.noop
 
 
+def _server(server, port: int = 53) -> Tuple[str, int]:
+    if isinstance(server, dict):
+        return server.get('host'), server.get('port', port)
+    return server, port
+
+
+class ChallengeCommand:
+    """http-01 challenges target deploying the challenges files using commands (e.g. rsync to a remote host)."""
+    __slots__ = ('deploy', 'clear')
+
+    def __init__(self, spec):
+        _check("auth:http:challenge_dir", {'deploy', 'clear'}, spec)
+        self.deploy = Hook('challenge_deploy', spec.get('deploy'))
+        self.clear = Hook('challenge_clear', spec['clear']) if spec.get('clear') else None
+
+
+ChallengeTarget = Union[str, ChallengeCommand]
+
+
+def _challenge_targets(value) -> Optional[List[ChallengeTarget]]:
+    if not value:
+        return None
+    if not isinstance(value, list):
+        value = [value]
+    return [ChallengeCommand(target) if isinstance(target, dict) else target for target in value]
+
+
 class HttpAuthDef(AuthDef):
     type = AuthType.http
 
     def __init__(self, spec, default=Optional['HttpAuthDef']):
         super().__init__()
-        _check("auth:http", {'challenge_dir', 'delay', 'retry'}, spec)
+        _check("auth:http", {'challenge_dir', 'listen', 'self_check', 'delay', 'retry'}, spec)
         challenge_dir = spec.get('challenge_dir', None)
 
         # noinspection PyProtectedMember
-        self._challenge_dirs = dict(default._challenge_dirs) if default else {}
-        if isinstance(challenge_dir, dict):
+        self._challenge_dirs = dict(default._challenge_dirs) if default else {}  # type: Dict[str, List[ChallengeTarget]]
+        if isinstance(challenge_dir, dict) and 'deploy' not in challenge_dir:
             # noinspection PyProtectedMember
-            self._default_dir = challenge_dir.pop('default', default._default_dir if default else None)
-            self._challenge_dirs.update(challenge_dir)
+            default_dir = challenge_dir.pop('default', None)
+            self._default_dir = _challenge_targets(default_dir) if default_dir else (default._default_dir if default else None)
+            self._challenge_dirs.update({domain: _challenge_targets(targets) for domain, targets in challenge_dir.items()})
+        else:
+            self._default_dir = _challenge_targets(challenge_dir)
+
+        # serve the challenges using a built-in http server instead of files
+        listen = spec.get('listen', None)
+        if listen is None:
+            self.listen = default.listen if default else None  # type: Optional[Tuple[str, int]]
         else:
-            self._default_dir = challenge_dir
+            self.listen = _server(listen, 80)
+        # fetch the challenges before answering them
+        self.self_check: bool = _get_bool(spec, 'self_check', default.self_check if default else False)
 
         self.delay: int = _get_int(spec, 'delay', default.delay if default else 10)
         self.retry: int = _get_int(spec, 'retry', default.retry if default else 30)
 
-    def challenge_directory(self, domain: str) -> Optional[str]:
-        challenge_dir = self._challenge_dirs.get(domain)
-        if challenge_dir:
-            return challenge_dir
+    def challenge_targets(self, domain: str) -> List[ChallengeTarget]:
+        """Return the directories (and commands) the challenges of domain must be deployed to."""
+        targets = self._challenge_dirs.get(domain)
+        if targets:
+            return targets
+
+        return [target.format(fqdn=domain) if isinstance(target, str) and '{fqdn' in target else target
+                for target in self._default_dir or []]
+
+
+class TlsAlpnAuthDef(AuthDef):
+    type = AuthType.tls_alpn
+
+    def __init__(self, spec, default=None):
+        super().__init__()
+        _check("auth:tls-alpn", {'listen', 'delay', 'retry'}, spec)
+        listen = spec.get('listen', None)
+        if listen is None:
+            self.listen = default.listen if default else ('', 443)  # type: Tuple[str, int]
+        else:
+            self.listen = _server(listen, 443)
 
-        http_challenge_directory = self._default_dir
-        if http_challenge_directory and '{fqdn' in http_challenge_directory:
-            http_challenge_directory = http_challenge_directory.format(fqdn=domain)
-        return http_challenge_directory
+        self.delay: int = _get_int(spec, 'delay', default.delay if default else 10)
+        self.retry: int = _get_int(spec, 'retry', default.retry if default else 30)
 
 
 class TsigKey:
@@ -193,7 +298,8 @@ class DnsAuthDef(AuthDef):
 
     def __init__(self, spec, default=Optional['DnsAuthDef']):
         super().__init__()
-        _check("auth:dns", {'key', 'zone', 'server', 'delay', 'retry'}, spec)
+        _check("auth:dns", {'key', 'zone', 'zone_cache', 'zone_cache_ttl', 'validation_zone', 'server', 'delay', 'retry',
+                            'propagation_timeout', 'propagation_delay', 'propagation_servers'}, spec)
 
         zone = spec.get('zone', None)
         # noinspection PyProtectedMember
@@ -204,6 +310,12 @@ class DnsAuthDef(AuthDef):
             self._zones.update(zone)
         else:
             self._default_zone = zone
+        # discovered zones cache file. None: default file in the data directory, False: zones are only kept in memory
+        self.zone_cache: Union[str, bool, None] = spec.get('zone_cache', default.zone_cache if default else None)
+        # number of seconds discovered zones are kept for
+        self.zone_cache_ttl: int = _get_int(spec, 'zone_cache_ttl', default.zone_cache_ttl if default else 7 * 86400)
+        # zone the _acme-challenge records are delegated to (using CNAME records)
+        self.validation_zone: Optional[str] = spec.get('validation_zone', default.validation_zone if default else None)
 
         # ditto for servers
         server = spec.get('server', None)
@@ -234,45 +346,80 @@ class DnsAuthDef(AuthDef):
         self.delay: int = _get_int(spec, 'delay', default.delay if default else 10)
         self.retry: int = _get_int(spec, 'retry', default.retry if default else 30)
 
+        # records propagation check. Disabled if timeout is 0 (opt-in).
+        self.propagation_timeout: int = _get_int(spec, 'propagation_timeout', default.propagation_timeout if default else 0)
+        self.propagation_delay: int = _get_int(spec, 'propagation_delay', default.propagation_delay if default else 5)
+        servers = spec.get('propagation_servers')
+        if servers is None:
+            self.propagation_servers = default.propagation_servers if default else None  # type: Optional[List[Tuple[str, int]]]
+        else:
+            self.propagation_servers = [_server(server) for server in _get_list(spec, 'propagation_servers')]
+
     def key(self, domain: str) -> Optional[TsigKey]:
         key = self._keys.get(domain)
         return key or self._default_key
 
     def server(self, domain: str) -> Optional[Tuple[str, int]]:
         server = self._servers.get(domain) or self._default_server
-        if isinstance(server, dict):
-            return server.get('host'), server.get('port', 53)
+        return _server(server) if server else None
 
-        return (server, 53) if server else None
-
-    def zone(self, domain: str) -> str:
-        zone = self._zones.get(domain)
-        if zone:
-            return zone
-
-        if self._default_zone:
-            return self._default_zone
-
-        # FIXME: default to assuming all zones are simple zones (name.tld)
-        # should use public suffix list instead
-        components = domain.rsplit('.', 2)
-        if len(components) <= 2:
-            return domain
-        return '.'.join(components[-2:])
+    def zone(self, domain: str) -> Optional[str]:
+        """Return the configured zone of domain. If None, the zone is discovered using DNS lookups."""
+        return self._zones.get(domain) or self._default_zone
 
 
 class HookAuthDef(AuthDef):
     type = AuthType.hook
 
+    MODES = ('common_name', 'each_domain', 'batch', 'parallel')
+
     def __init__(self, spec, default=Optional['HookAuthDef']):
         super().__init__()
+        _check("auth:hook", {'command', 'each_domain', 'mode', 'challenge', 'concurrency', 'timeout', 'delay', 'retry'}, spec)
         cmd = spec.get('command')
         if not cmd:
             log.raise_error('auth: hook auth requires a command.')
         self.cmd = Hook('auth', cmd)
+        if spec.get('timeout') is not None:
+            self.cmd.timeout = _get_int(spec, 'timeout')
+        elif default and self.cmd.timeout is None:
+            self.cmd.timeout = default.cmd.timeout
         # each_domain: if true, call hook for each domain that needs auth
         #              if false, call it once per csr with the csr common name as parameter
         self.each_domain: bool = spec.get('each_domain', default.each_domain if default else False)
+        # batch: call hook once with all the challenges on its standard input
+        # parallel: call hook for each challenge, concurrently
+        if 'each_domain' in spec or not default:
+            self.mode: str = spec.get('mode', 'each_domain' if self.each_domain else 'common_name')
+        else:
+            self.mode: str = spec.get('mode', default.mode)
+        if self.mode not in self.MODES:
+            log.raise_error('auth: hook mode must be one of %s', ', '.join(f'"{mode}"' for mode in self.MODES))
+        # challenge type published by the hook in batch and parallel modes
+        self.challenge: str = spec.get('challenge', default.challenge if default else 'dns-01')
+        self.concurrency: int = _get_int(spec, 'concurrency', default.concurrency if default else 10)
+
+        self.delay: int = _get_int(spec, 'delay', default.delay if default else 10)
+        self.retry: int = _get_int(spec, 'retry', default.retry if default else 30)
+
+
+class PluginAuthDef(AuthDef):
+    type = AuthType.plugin
+
+    def __init__(self, spec, default=None):
+        super().__init__()
+        _check("auth:plugin", {'driver', 'options', 'delay', 'retry'}, spec)
+        # driver: "module:class" or entry point name of an AuthDriver subclass, instantiated with the acme client and this auth
+        self.driver: str = spec.get('driver', default.driver if default else None)
+        if not self.driver or not isinstance(self.driver, str):
+            log.raise_error('auth: plugin auth requires a driver.')
+        # options: passed as is to the driver
+        self.options: dict = spec.get('options', default.options if default else {})
+        if not isinstance(self.options, dict):
+            log.raise_error('auth: plugin options must be a dictionary.')
+
+        self.delay: int = _get_int(spec, 'delay', default.delay if default else 10)
+        self.retry: int = _get_int(spec, 'retry', default.retry if default else 30)
 
 
 class PrivateKeyDef:
@@ -406,7 +553,8 @@ _DEFAULT_HOOKS = {
     'params_installed': None,
     'sct_installed': None,
     'ocsp_installed': None,
-    'certificates_updated': None
+    'certificates_updated': None,
+    'files_updated': None,
 }
 
 _DEFAULT_CT_LOGS = {
@@ -509,6 +657,7 @@ class Configuration:
                 else:
                     log.warning('unknown section name: "%s"', section)
 
+            cfg.services = {name: ServiceDef(name, spec) for name, spec in cfg.services.items() if spec}
             auth = AuthDef.parse(cfg.settings['auth'])
             verify = VerifyDef(cfg.settings['verify'])
             certificates = data.get('certificates')
@@ -531,12 +680,19 @@ class Configuration:
             'log_file': '/var/log/certmgr/certmgr.log',
 
             'acme_directory_url': 'https://acme-v02.api.letsencrypt.org/directory',
+            'acme_directory_ttl': 86400,
             'renewal_days': 30,
             'archive_days': 30,
             'cert_poll_time': 30,
+            'inventory': True,
+            'metrics_file': None,
+            'hooks_concurrency': 1,
             # running with random wait time
             'min_run_delay': 300,
             'max_run_delay': 3600,
+            # running as a daemon
+            'daemon_retry_delay': 3600,
+            'sct_refresh_days': 1,
 
             # certificates default values
             'file_user': None,
@@ -560,7 +716,8 @@ class Configuration:
             'lock_file': '/var/run/lock/certmgr.lock',
         }
 
-        self.services = {
+        # command line strings or dictionaries, parsed once loaded
+        self.services = {  # type: Dict[str, Union[str, dict, ServiceDef]]
             'apache': 'systemctl reload apache2',
             'coturn': 'systemctl restart coturn',
             'dovecot': 'systemctl restart dovecot',
@@ -589,8 +746,8 @@ class Configuration:
     def list(self, key: str, default=()):
         return _get_list(self.settings, key, default)
 
-    def service(self, service_name: str) -> Optional[str]:
-        return self.services[service_name]
+    def service(self, service_name: str) -> Optional[ServiceDef]:
+        return self.services.get(service_name)
 
     def certificate(self, name: str) -> List[CertificateDef]:
         cert = self._certificates.get(name)
@@ -671,7 +828,7 @@ class Configuration:
     def _merge_settings(self, values):
         _merge('settings', self.settings, values)
         basedir = os.path.dirname(self.path)
-        for file in ('log_file', 'lock_file', 'data_dir'):
+        for file in ('log_file', 'lock_file', 'data_dir', 'metrics_file'):
             value = self.get(file)
             if value and not os.path.isabs(value):
                 self.settings[file] = os.path.join(basedir, value)
@@ -2,15 +2,19 @@ import datetime
 import os
 import re
 import struct
-from typing import List, Optional, Tuple
+from typing import List, Optional, TYPE_CHECKING, Tuple
 
 from .config import CertificateDef
-from .crypto import Certificate, PrivateKey, check_dhparam, check_ecparam, load_full_chain_file, save_chain
 from .logging import log
 from .ocsp import OCSP
 from .sct import SCTData, SCTLog
 from .utils import ArchiveAndWriteOperation, FileOwner, KeyCipherData, WriteOperation, get_key_cipher
 
+# cryptography is slow to import, and the inventory (and sqlite) is only needed by the actions using it
+if TYPE_CHECKING:
+    from .crypto import Certificate, PrivateKey
+    from .inventory import Inventory
+
 _UNINITIALIZED = 'uninitialized'
 
 
@@ -47,12 +51,30 @@ class CertificateItem:
     def updated(self):
         return self._certificate_updated or self._ocsp_response_updated or any(sct[1] for sct in self._scts.values())
 
+    def clear_updated(self):
+        self._certificate_updated = False
+        self._ocsp_response_updated = False
+        self._scts = {name: (sct, False) for name, (sct, _) in self._scts.items()}
+
     @property
-    def key(self) -> PrivateKey:
+    def key(self) -> 'PrivateKey':
         if self._key is _UNINITIALIZED:
             self._key = self._load_key()
         return self._key
 
+    @property
+    def loaded_key(self) -> Optional['PrivateKey']:
+        # the key if already loaded. Don't load (and decrypt) it.
+        return None if self._key is _UNINITIALIZED else self._key
+
+    @property
+    def key_encrypted(self) -> bool:
+        if self._key is _UNINITIALIZED and self.context.inventory:
+            info = self.context.inventory.key_info(self)
+            if info:
+                return info.encrypted
+        return self.key.encrypted
+
     def key_path(self, full=False):
         return os.path.join(self.data_dir, 'keys', 'key+cert.pem' if full else 'key.pem')
 
@@ -74,7 +96,9 @@ class CertificateItem:
                 self.certificate.dump(f, self.chain, self.context.dhparam, self.context.ecparam)
         return op
 
-    def _load_key(self) -> Optional[PrivateKey]:
+    def _load_key(self) -> Optional['PrivateKey']:
+        from .crypto import PrivateKey
+
         key_file_path = self.key_path()
         try:
             return PrivateKey.load(key_file_path, lambda: self.context.key_cipher(force_prompt=True).passphrase)
@@ -82,7 +106,7 @@ class CertificateItem:
             log.raise_error("private key '%s' loading failed", key_file_path, cause=e)
 
     @property
-    def certificate(self) -> Certificate:
+    def certificate(self) -> 'Certificate':
         if self._certificate is _UNINITIALIZED:
             self._load_certificate_and_chain()
         return self._certificate
@@ -90,7 +114,7 @@ class CertificateItem:
     def certificate_path(self, full=False):
         return os.path.join(self.data_dir, 'cert+root.pem' if full else 'cert.pem')
 
-    def save_certificate(self, owner: FileOwner, root: Optional[Certificate] = None) -> Optional[WriteOperation]:
+    def save_certificate(self, owner: FileOwner, root: Optional['Certificate'] = None) -> Optional[WriteOperation]:
         cert_path = self.certificate_path(full=root is not None)
         if not cert_path:
             return None
@@ -100,7 +124,7 @@ class CertificateItem:
         return op
 
     @property
-    def chain(self) -> List[Certificate]:
+    def chain(self) -> List['Certificate']:
         if self._chain is _UNINITIALIZED:
             self._load_certificate_and_chain()
         return self._chain
@@ -112,12 +136,14 @@ class CertificateItem:
         chain_path = self.chain_path()
         if not chain_path:
             return None
+        from .crypto import save_chain
+
         op = ArchiveAndWriteOperation('certificates', chain_path, mode=0o644, owner=owner)
         with op.file() as f:
             save_chain(f, self.chain)
         return op
 
-    def update(self, key: PrivateKey, cert: Certificate, chain: List[Certificate]):
+    def update(self, key: 'PrivateKey', cert: 'Certificate', chain: List['Certificate']):
         self._certificate_updated = self._key is not key or self._certificate is not cert or self._chain is not chain
         self._certificate = cert
         self._chain = chain
@@ -128,6 +154,8 @@ class CertificateItem:
         return self._certificate_updated
 
     def _load_certificate_and_chain(self):
+        from .crypto import load_full_chain_file
+
         cert_path = self.certificate_path()
         try:
             certificate, chain = load_full_chain_file(cert_path)
@@ -140,15 +168,20 @@ class CertificateItem:
             log.raise_error("certificate '%s' loading failed", cert_path, cause=e)
 
     def should_renew(self, renewal_days: int):
-        if not self.key or not self.certificate:
-            return True
+        inventory = self.context.inventory
+        key = inventory.key_info(self) if inventory else None
+        certificate = inventory.certificate_info(self) if key else None
+        if not certificate:
+            if not self.key or not self.certificate:
+                return True
+            from .inventory import CertificateInfo, KeyInfo
+            key = KeyInfo.from_key(self.key)
+            certificate = CertificateInfo.from_certificate(self.certificate)
 
-        key = self.key
         if key.params != self.params:
-            log.info('Private key is not %s', str(key))
+            log.info('Private key is not %s', key.description)
             return True
 
-        certificate = self.certificate
         if self.config.common_name != certificate.common_name:
             log.info('Common name changed from %s to %s', certificate.common_name, self.config.common_name)
             return True
@@ -163,12 +196,12 @@ class CertificateItem:
             log.info('Alt names changed%s%s', (', adding ' + added) if added else '', (', removing ' + removed) if removed else '')
             return True
 
-        if not key.match_certificate(certificate):
+        if key.digest != certificate.public_key_digest:
             log.info('certificate public key does not match private key')
             return True
 
-        if certificate.has_oscp_must_staple != self.config.ocsp_must_staple:
-            log.info('certificate %s ocsp_must_staple option', 'has' if certificate.has_oscp_must_staple else 'does not have')
+        if certificate.must_staple != self.config.ocsp_must_staple:
+            log.info('certificate %s ocsp_must_staple option', 'has' if certificate.must_staple else 'does not have')
             return True
 
         valid_duration = (certificate.not_after - datetime.datetime.utcnow())
@@ -218,6 +251,9 @@ class CertificateItem:
             self._scts[ct_log.name] = self._load_sct(ct_log), False
         return self._scts[ct_log.name]
 
+    def sct_updated(self, ct_log: SCTLog) -> bool:
+        return ct_log.name in self._scts and self._scts[ct_log.name][1]
+
     def update_sct(self, ct_log: SCTLog, sct_data: SCTData):
         self._scts[ct_log.name] = sct_data, sct_data != self._scts.get(ct_log.name)
 
@@ -264,9 +300,10 @@ class CertificateContext:
 
     # __slots__ = ('name', 'spec', 'params', 'params_updated', 'certificates')
 
-    def __init__(self, config: CertificateDef, data_dir: str, root_path: str):
+    def __init__(self, config: CertificateDef, data_dir: str, root_path: str, inventory: Optional['Inventory'] = None):
         self.config = config
         self.data_dir = os.path.join(data_dir, config.name)
+        self.inventory = inventory
 
         self._dhparam = _UNINITIALIZED  # type: bytes
         self._ecparam = _UNINITIALIZED  # type: bytes
@@ -291,6 +328,14 @@ class CertificateContext:
     def updated(self) -> bool:
         return self._params_updated or any(item.updated for item in self._items)
 
+    def clear_updated(self):
+        """
+        Forget pending changes once they are committed, so the context can be processed again (daemon mode).
+        """
+        self._params_updated = False
+        for item in self._items:
+            item.clear_updated()
+
     @property
     def dhparam(self) -> Optional[bytes]:
         if self._dhparam is _UNINITIALIZED:
@@ -349,8 +394,10 @@ class CertificateContext:
     def domain_names(self):
         return self.config.alt_names
 
-    def root_certificate(self, key_type: str) -> Optional[Certificate]:
+    def root_certificate(self, key_type: str) -> Optional['Certificate']:
         if key_type not in self._root_certificates:
+            from .crypto import Certificate
+
             cert_path = os.path.join(os.path.dirname(self._root_path), f'root_cert.{key_type}.pem')
             self._root_certificates[key_type] = Certificate.load(cert_path)
         return self._root_certificates[key_type]
@@ -390,6 +437,8 @@ class CertificateContext:
         dhparam_pem = (match.group(1) + b'\n') if match else None
         match = re.search(br'(-----BEGIN EC PARAMETERS-----.*-----END EC PARAMETERS-----)', pem_data, re.DOTALL)
         ecparam_pem = (match.group(1) + b'\n') if match else None
+        from .crypto import check_dhparam, check_ecparam
+
         if dhparam_pem and not check_dhparam(dhparam_pem):
             dhparam_pem = None
         self._dhparam = dhparam_pem
@@ -6,7 +6,6 @@ from datetime import datetime
 from io import BytesIO
 from typing import Callable, Dict, Iterable, List, Optional, Tuple, Type, TypeVar, Union
 
-import requests
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
@@ -87,7 +86,7 @@ class PrivateKey(metaclass=abc.ABCMeta):
             curve = _supported_curves().get(params)
             if not curve:
                 raise NotImplementedError('Unsupported key curve: ' + params)
-            return _ECDSAKey(ec.generate_private_key(curve, default_backend()))
+            return _ECDSAKey(ec.generate_private_key(curve(), default_backend()))
         raise NotImplementedError('Unsupported key type ' + key_type.upper())
 
     @staticmethod
@@ -363,6 +362,8 @@ def get_ecparam_curve(ecparam_pem: bytes) -> str:
 def fetch_dhparam(dhparam_size: int) -> Optional[str]:
     if dhparam_size not in (2048, 3072, 4096, 8192):
         return log.error("--fast-params only supports 2048, 3072, 4096 and 8192 bit param (and not %s)", dhparam_size)
+    import requests  # slow to import, and only needed here
+
     url = f"https://2ton.com.au/getprimes/random/dhparam/{dhparam_size}"
     try:
         log.progress('Fetching %s bit Diffie-Hellman parameters', dhparam_size)
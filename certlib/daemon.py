@@ -0,0 +1,221 @@
+# Long running scheduler
+import argparse
+import collections
+import datetime
+import heapq
+import itertools
+import signal
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from . import AcmeError
+from .config import Configuration
+from .context import CertificateContext
+from .logging import log
+from .ocsp import refresh_time
+from .update import UpdateAction
+from .utils import LazyClient
+
+RENEWAL = 'certs'
+OCSP = 'ocsp'
+SCT = 'sct'
+
+_ALL_TASKS = frozenset((RENEWAL, OCSP, SCT))
+
+# wake up at least once an hour, so a clock change (or a suspended host) does not delay the tasks for too long
+_MAX_SLEEP = 3600
+
+
+def _timestamp(value: datetime.datetime) -> float:
+    # certificates and OCSP dates are naive UTC dates
+    return value.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def _isoformat(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def renewal_due(context: CertificateContext, renewal_days: int, now: float) -> float:
+    due = None
+    for item in context:
+        with log.prefix(f'  - [{item.type.upper()}] '):
+            if item.should_renew(renewal_days):
+                return now
+        item_due = _timestamp(item.certificate.not_after - datetime.timedelta(days=renewal_days))
+        due = item_due if due is None else min(due, item_due)
+    return due if due is not None else now
+
+
+def ocsp_due(context: CertificateContext, now: float) -> Optional[float]:
+    if not context.config.ocsp_responder_urls:
+        return None
+
+    due = None
+    for item in context:
+        certificate = item.certificate
+        if not certificate:
+            # will be fetched once the certificate is issued
+            continue
+        response = item.ocsp_response
+        if not response or response.serial_number != certificate.serial_number or not response.this_update:
+            return now
+        item_due = _timestamp(refresh_time(response.this_update, response.next_update))
+        due = item_due if due is None else min(due, item_due)
+    return due
+
+
+def sct_due(context: CertificateContext, last_check: float, interval: int, now: float) -> Optional[float]:
+    if not context.config.ct_submit_logs:
+        return None
+
+    for item in context:
+        if not item.certificate:
+            continue
+        for ct_log in context.config.ct_submit_logs:
+            sct_data, _ = item.sct(ct_log)
+            if not sct_data:
+                return now
+    return last_check + interval
+
+
+class Daemon:
+    has_acme_client = True
+    uses_inventory = True
+    exports_metrics = True
+
+    @classmethod
+    def add_arguments(cls, parser: argparse.ArgumentParser):
+        parser.add_argument('certificate_names', nargs='*')
+        parser.add_argument('--verify',
+                            action='store_true', dest='verify', default=False,
+                            help='Verify installed certificates after each update')
+        parser.add_argument('--no-auth',
+                            action='store_true', dest='no_auth', default=False,
+                            help='Assume all domain names are already verified and do not perform any authorization')
+        parser.set_defaults(cls=cls)
+
+    def __init__(self, config: Configuration, args: argparse.Namespace, contexts: List[CertificateContext], acme_client: Optional[LazyClient],
+                 process: Callable[[UpdateAction, List[CertificateContext]], Tuple[List[str], List[str]]]):
+        self.config = config
+        self.args = args
+        self.acme_client = acme_client
+        self.contexts = collections.OrderedDict((context.name, context) for context in contexts)  # type: Dict[str, CertificateContext]
+        self.process = process
+
+        self.renewal_days = config.int('renewal_days')
+        self.retry_delay = max(config.int('daemon_retry_delay'), 60)
+        self.sct_interval = config.int('sct_refresh_days') * 86400
+
+        self._queue = []  # type: List[Tuple[float, int, str, str]]
+        self._due = {}  # type: Dict[Tuple[str, str], float]
+        self._counter = itertools.count()
+        self._sct_checked = {}  # type: Dict[str, float]
+        self._stop = threading.Event()
+
+    def stop(self, *args):
+        log.info('stopping daemon')
+        self._stop.set()
+
+    def run(self) -> Tuple[List, List]:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        log.progress('Scheduling %s certificates', len(self.contexts))
+        now = time.time()
+        for context in self.contexts.values():
+            # assume scts were refreshed by the last run
+            self._sct_checked[context.name] = now
+            self._schedule(context, _ALL_TASKS, now)
+
+        while not self._stop.is_set():
+            due = self._next_due()
+            if due is None:
+                log.warning("nothing to schedule !")
+                break
+
+            delay = due - time.time()
+            if delay > 0:
+                log.debug('sleeping until %s', _isoformat(due))
+                self._stop.wait(min(delay, _MAX_SLEEP))
+                continue
+
+            self._run_tasks(self._pop_due(time.time()))
+        return (), ()
+
+    # ----- Queue management
+    def _schedule(self, context: CertificateContext, tasks: Iterable[str], now: float, retry: bool = False):
+        with log.prefix(f'[{context.name}] '):
+            for task in tasks:
+                try:
+                    if RENEWAL == task:
+                        due = renewal_due(context, self.renewal_days, now)
+                    elif OCSP == task:
+                        due = ocsp_due(context, now)
+                    else:
+                        due = sct_due(context, self._sct_checked[context.name], self.sct_interval, now)
+                except AcmeError as e:
+                    log.error("can't schedule %s: %s", task, str(e))
+                    due = now + self.retry_delay
+
+                if due is None:
+                    self._due.pop((context.name, task), None)
+                    continue
+                if retry and due <= now:
+                    # the last run did not fix it. Don't try again immediately.
+                    due = now + self.retry_delay
+
+                log.debug('next %s at %s', task, _isoformat(due))
+                self._due[(context.name, task)] = due
+                heapq.heappush(self._queue, (due, next(self._counter), context.name, task))
+
+    def _next_due(self) -> Optional[float]:
+        while self._queue:
+            due, _, name, task = self._queue[0]
+            if self._due.get((name, task)) == due:
+                return due
+            # rescheduled or cancelled entry
+            heapq.heappop(self._queue)
+        return None
+
+    def _pop_due(self, now: float) -> Dict[str, Set[str]]:
+        tasks = collections.OrderedDict()  # type: Dict[str, Set[str]]
+        while self._queue and self._queue[0][0] <= now:
+            due, _, name, task = heapq.heappop(self._queue)
+            if self._due.get((name, task)) != due:
+                continue
+            del self._due[(name, task)]
+            tasks.setdefault(name, set()).add(task)
+        return tasks
+
+    # ----- Processing
+    def _run_tasks(self, tasks: Dict[str, Set[str]]):
+        # process together certificates with the same tasks
+        batches = collections.OrderedDict()  # type: Dict[frozenset, List[CertificateContext]]
+        for name, names in tasks.items():
+            # a renewal is a full update
+            batches.setdefault(_ALL_TASKS if RENEWAL in names else frozenset(names), []).append(self.contexts[name])
+
+        for batch, contexts in batches.items():
+            args = argparse.Namespace(**vars(self.args))
+            args.certs = args.params = RENEWAL in batch
+            args.ocsp = OCSP in batch
+            args.sct = SCT in batch
+            args.force = False
+
+            if self.acme_client:
+                # the ACME service may be back
+                self.acme_client.clear_error()
+            log.progress('Updating %s for %s', ', '.join(sorted(batch)), ', '.join(context.name for context in contexts))
+            try:
+                _, errors = self.process(UpdateAction(self.config, args, contexts, self.acme_client), contexts)
+            except Exception as e:
+                log.error('update failed: %s', str(e), print_exc=True)
+                errors = [context.name for context in contexts]
+
+            now = time.time()
+            for context in contexts:
+                context.clear_updated()
+                if SCT in batch and context.name not in errors:
+                    self._sct_checked[context.name] = now
+                self._schedule(context, batch, now, retry=True)
@@ -0,0 +1,233 @@
+# Persistent index of the installed files.
+#
+# Loading certificates, decrypting keys and checking params (using openssl) for every certificate on each run is costly.
+# The inventory records what the update action needs to know about these files, and each record is validated
+# using the files mtime, inode and size, so any change made outside of this tool invalidates it.
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+from .crypto import Certificate, PrivateKey, get_dhparam_size, get_ecparam_curve
+from .logging import log
+from .ocsp import refresh_time
+
+_SCHEMA_VERSION = 2
+
+# key type used to store the certificate params record
+_PARAMS = ''
+
+
+def _signature(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    # JSON friendly value
+    return [st.st_mtime_ns, st.st_ino, st.st_size]
+
+
+def _timestamp(value: Optional[datetime.datetime]) -> Optional[float]:
+    # certificates and OCSP dates are naive UTC dates
+    return value.replace(tzinfo=datetime.timezone.utc).timestamp() if value else None
+
+
+def _datetime(value: Optional[float]) -> Optional[datetime.datetime]:
+    return datetime.datetime.utcfromtimestamp(value) if value is not None else None
+
+
+class KeyInfo(NamedTuple):
+    params: Union[int, str]
+    description: str
+    encrypted: bool
+    digest: str
+
+    @classmethod
+    def from_key(cls, key: PrivateKey) -> 'KeyInfo':
+        return cls(key.params, str(key), key.encrypted, key.public_key_digest().hex())
+
+
+class CertificateInfo(NamedTuple):
+    serial_number: int
+    common_name: str
+    alt_names: List[str]
+    public_key_digest: str
+    must_staple: bool
+    not_before: datetime.datetime
+    not_after: datetime.datetime
+
+    @classmethod
+    def from_certificate(cls, certificate: Certificate) -> 'CertificateInfo':
+        return cls(certificate.serial_number, certificate.common_name, list(certificate.alt_names),
+                   hashlib.sha256(certificate.public_key_bytes()).hexdigest(), certificate.has_oscp_must_staple,
+                   certificate.not_before, certificate.not_after)
+
+    def to_json(self) -> dict:
+        value = self._asdict()
+        value['not_before'] = _timestamp(self.not_before)
+        value['not_after'] = _timestamp(self.not_after)
+        return value
+
+    @classmethod
+    def from_json(cls, value: dict) -> 'CertificateInfo':
+        return cls(**dict(value, not_before=_datetime(value['not_before']), not_after=_datetime(value['not_after'])))
+
+
+class Inventory:
+
+    @classmethod
+    def open(cls, data_dir: str) -> Optional['Inventory']:
+        path = os.path.join(data_dir, 'inventory.db')
+        try:
+            os.makedirs(data_dir, 0o755, exist_ok=True)
+            return cls(path)
+        except (OSError, sqlite3.Error) as e:
+            log.warning("unable to open inventory '%s': %s", path, str(e))
+            return None
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        os.chmod(path, 0o600)
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != _SCHEMA_VERSION:
+            with self._db:
+                self._db.execute('DROP TABLE IF EXISTS inventory')
+                self._db.execute('CREATE TABLE inventory (name TEXT NOT NULL, key_type TEXT NOT NULL, record TEXT NOT NULL, '
+                                 'PRIMARY KEY (name, key_type))')
+                self._db.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+        self._records = {(name, key_type): json.loads(record)
+                         for name, key_type, record in self._db.execute('SELECT name, key_type, record FROM inventory')}  # type: Dict[Tuple[str, str], dict]
+        log.debug("inventory '%s' loaded (%s records)", path, len(self._records))
+
+    def _record(self, name: str, key_type: str) -> dict:
+        return self._records.get((name, key_type)) or {}
+
+    def _update(self, name: str, key_type: str, record: dict):
+        with self._lock:
+            if self._records.get((name, key_type)) != record:
+                self._records[(name, key_type)] = record
+                self._dirty.add((name, key_type))
+
+    # ----- Lookups: return None if nothing valid is recorded
+    def key_info(self, item) -> Optional[KeyInfo]:
+        record = self._record(item.name, item.type)
+        if not record.get('key') or record.get('key_sig') != _signature(item.key_path()):
+            return None
+        return KeyInfo(**record['key'])
+
+    def certificate_info(self, item) -> Optional[CertificateInfo]:
+        record = self._record(item.name, item.type)
+        if not record.get('certificate') or record.get('certificate_sig') != _signature(item.certificate_path()):
+            return None
+        return CertificateInfo.from_json(record['certificate'])
+
+    def ocsp_dates(self, item) -> Optional[Tuple[datetime.datetime, Optional[datetime.datetime]]]:
+        """Return the this_update and next_update dates of the OCSP response of the current certificate."""
+        certificate = self.certificate_info(item)
+        if not certificate:
+            return None
+        record = self._record(item.name, item.type)
+        ocsp = record.get('ocsp')
+        if not ocsp or ocsp['serial_number'] != certificate.serial_number or record.get('ocsp_sig') != _signature(item.ocsp_path()):
+            return None
+        return _datetime(ocsp['this_update']), _datetime(ocsp['next_update'])
+
+    def ocsp_refresh_time(self, item) -> Optional[datetime.datetime]:
+        dates = self.ocsp_dates(item)
+        return refresh_time(*dates) if dates else None
+
+    def _sct_record(self, item) -> Optional[dict]:
+        if not self.certificate_info(item):
+            return None
+        record = self._record(item.name, item.type)
+        signatures = record.get('sct_sigs') or {}
+        for ct_log in item.config.ct_submit_logs:
+            signature = _signature(item.sct_path(ct_log))
+            if not signature or signatures.get(ct_log.name) != signature:
+                return None
+        return record
+
+    def sct_checked(self, item) -> Optional[datetime.datetime]:
+        record = self._sct_record(item)
+        return _datetime(record.get('sct_checked')) if record else None
+
+    def sct_timestamps(self, item) -> Optional[Dict[str, int]]:
+        """Return the timestamp (in ms) of the SCT of each log."""
+        record = self._sct_record(item)
+        return record.get('sct_timestamps') if record else None
+
+    def params(self, context) -> Optional[Tuple[int, Optional[str]]]:
+        record = self._record(context.name, _PARAMS)
+        signature = record.get('params_sig')
+        if not signature or signature != _signature(context.params_path):
+            return None
+        return record['dhparam_size'], record['ecparam_curve']
+
+    # ----- Updates
+    def refresh(self, context, sct_checked: bool = False):
+        """
+        Record the current state of the context files.
+        Files are loaded only if they did change, and the keys only if they are already loaded.
+        """
+        for item in context:
+            record = dict(self._record(item.name, item.type))
+
+            signature = _signature(item.key_path())
+            if signature != record.get('key_sig') or not record.get('key'):
+                key = item.loaded_key
+                record['key'] = KeyInfo.from_key(key)._asdict() if key and signature else None
+                record['key_sig'] = signature
+
+            signature = _signature(item.certificate_path())
+            if signature != record.get('certificate_sig') or not record.get('certificate'):
+                certificate = item.certificate if signature else None
+                record['certificate'] = CertificateInfo.from_certificate(certificate).to_json() if certificate else None
+                record['certificate_sig'] = signature
+
+            signature = _signature(item.ocsp_path())
+            if signature != record.get('ocsp_sig'):
+                ocsp = item.ocsp_response if signature else None
+                record['ocsp'] = {
+                    'serial_number': ocsp.serial_number,
+                    'this_update': _timestamp(ocsp.this_update),
+                    'next_update': _timestamp(ocsp.next_update),
+                } if ocsp and ocsp.this_update else None
+                record['ocsp_sig'] = signature
+
+            signatures = {ct_log.name: _signature(item.sct_path(ct_log)) for ct_log in item.config.ct_submit_logs}
+            if signatures != record.get('sct_sigs') or 'sct_timestamps' not in record:
+                scts = {ct_log.name: item.sct(ct_log)[0] if signatures[ct_log.name] else None for ct_log in item.config.ct_submit_logs}
+                record['sct_timestamps'] = {name: sct.timestamp for name, sct in scts.items() if sct}
+            record['sct_sigs'] = signatures
+            if sct_checked:
+                record['sct_checked'] = _timestamp(datetime.datetime.utcnow())
+
+            self._update(item.name, item.type, record)
+
+        record = dict(self._record(context.name, _PARAMS))
+        signature = _signature(context.params_path)
+        if signature != record.get('params_sig'):
+            dhparam = context.dhparam if signature else None
+            ecparam = context.ecparam if signature else None
+            record['dhparam_size'] = get_dhparam_size(dhparam) if dhparam else 0
+            record['ecparam_curve'] = get_ecparam_curve(ecparam) if ecparam else None
+            record['params_sig'] = signature
+            self._update(context.name, _PARAMS, record)
+
+    def commit(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            rows = [(name, key_type, json.dumps(self._records[(name, key_type)])) for name, key_type in self._dirty]
+            self._dirty.clear()
+            try:
+                with self._db:
+                    self._db.executemany('INSERT OR REPLACE INTO inventory (name, key_type, record) VALUES (?, ?, ?)', rows)
+            except sqlite3.Error as e:
+                log.warning("unable to save inventory '%s': %s", self.path, str(e))
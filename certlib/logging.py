@@ -1,14 +1,25 @@
 import contextlib
+import contextvars
+import io
 import logging
 import sys
+import threading
 import traceback
-from typing import NoReturn, Optional
+from typing import List, NoReturn, Optional
 
 from . import AcmeError
 
 PROGRESS = 25
 logging.addLevelName(PROGRESS, "PROGRESS")
 
+# Prefix and extra fields are bound to the current thread / asyncio task,
+# so concurrent workers each get their own prefix stack.
+_extra: contextvars.ContextVar[dict] = contextvars.ContextVar('certmgr_log_extra', default={'prefix': ''})
+# Records (and tracebacks) held back by log.buffered() for the current thread / task.
+_buffer: contextvars.ContextVar[Optional[List]] = contextvars.ContextVar('certmgr_log_buffer', default=None)
+# Serialize buffer flushes so the output of a task is never interleaved with another one.
+_flush_lock = threading.RLock()
+
 
 class _Formatter(logging.Formatter):
     def __init__(self):
@@ -68,13 +79,33 @@ class ColorFormatter(_Formatter):
         return f'\033[{self._style_codes[style]};{self._color_codes[color]}m{msg}\033[0m'
 
 
+class _BufferFilter(logging.Filter):
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        buffer = _buffer.get()
+        if buffer is None:
+            return True
+        buffer.append(record)
+        return False
+
+
 class _Logger(logging.LoggerAdapter):
 
     def __init__(self, logger):
-        super().__init__(logger, {'prefix': ''})
+        super().__init__(logger, None)
         self._stream = None  # type: logging.StreamHandler
         self._file = None
         self.setLevel(logging.DEBUG)
+        self.logger.addFilter(_BufferFilter())
+
+    @property
+    def extra(self) -> dict:
+        return _extra.get()
+
+    @extra.setter
+    def extra(self, value):
+        # LoggerAdapter.__init__ assign it. extra fields are managed using the extra_fields() context manager.
+        pass
 
     def process(self, msg, kwargs):
         extra = kwargs.get('extra')
@@ -85,12 +116,56 @@ class _Logger(logging.LoggerAdapter):
             kwargs["extra"] = self.extra
         return msg, kwargs
 
+    @contextlib.contextmanager
+    def extra_fields(self, **fields):
+        """
+        Add extra fields to all records logged by the current thread (or task) in this block.
+        """
+        extra = dict(self.extra)
+        extra.update(fields)
+        token = _extra.set(extra)
+        try:
+            yield
+        finally:
+            _extra.reset(token)
+
     @contextlib.contextmanager
     def prefix(self, prefix: str):
-        orig = self.extra['prefix']
-        self.extra['prefix'] += prefix
-        yield
-        self.extra['prefix'] = orig
+        with self.extra_fields(prefix=self.extra['prefix'] + prefix):
+            yield
+
+    @contextlib.contextmanager
+    def buffered(self):
+        """
+        Hold back records logged by the current thread (or task) in this block,
+        and emit them all at once when leaving it.
+        """
+        if _buffer.get() is not None:
+            # already buffered by an outer block
+            yield
+            return
+
+        records = []
+        token = _buffer.set(records)
+        try:
+            yield
+        finally:
+            _buffer.reset(token)
+            with _flush_lock:
+                for record in records:
+                    if isinstance(record, str):
+                        sys.stderr.write(record)
+                    else:
+                        self.logger.handle(record)
+
+    def _print_exc(self):
+        buffer = _buffer.get()
+        if buffer is None:
+            traceback.print_exc()
+        else:
+            with io.StringIO() as f:
+                traceback.print_exc(file=f)
+                buffer.append(f.getvalue())
 
     @property
     def color(self) -> bool:
@@ -140,7 +215,7 @@ class _Logger(logging.LoggerAdapter):
         """
         super().debug(msg, *args, **kwargs)
         if print_exc:
-            traceback.print_exc()
+            self._print_exc()
 
     def info(self, msg, *args, print_exc: bool = False, **kwargs):
         """
@@ -148,7 +223,7 @@ class _Logger(logging.LoggerAdapter):
         """
         super().info(msg, *args, **kwargs)
         if print_exc and self.isEnabledFor(logging.DEBUG):
-            traceback.print_exc()
+            self._print_exc()
 
     def progress(self, msg, *args, **kwargs):
         self.log(25, msg, *args, **kwargs)
@@ -159,7 +234,7 @@ class _Logger(logging.LoggerAdapter):
         """
         super().warning(msg, *args, **kwargs)
         if print_exc and self.isEnabledFor(logging.DEBUG):
-            traceback.print_exc()
+            self._print_exc()
 
     def error(self, msg, *args, print_exc: bool = False, **kwargs):
         """
@@ -167,7 +242,7 @@ class _Logger(logging.LoggerAdapter):
         """
         super().error(msg, *args, **kwargs)
         if print_exc and self.isEnabledFor(logging.DEBUG):
-            traceback.print_exc()
+            self._print_exc()
 
     def critical(self, msg, *args, print_exc: bool = False, **kwargs):
         """
@@ -175,7 +250,7 @@ class _Logger(logging.LoggerAdapter):
         """
         super().critical(msg, *args, **kwargs)
         if print_exc and self.isEnabledFor(logging.DEBUG):
-            traceback.print_exc()
+            self._print_exc()
 
     def raise_error(self, msg, *args, cause=None, **kwargs) -> NoReturn:
         self.critical(msg, *args, **kwargs)
@@ -1,20 +1,41 @@
 import argparse
 import contextlib
 import fcntl
+import importlib
 import logging
 import os
 import random
 import sys
 import time
-from typing import List, Tuple
+from collections import OrderedDict
+from typing import List, TYPE_CHECKING, Tuple
 
-from acme import client
-
-from . import AcmeError, VERSION, acme, actions
+from . import AcmeError, VERSION, metrics, profiling, trace
 from .config import Configuration
 from .context import CertificateContext
 from .logging import PROGRESS, log
-from .update import UpdateAction
+from .utils import LazyClient
+
+if TYPE_CHECKING:
+    from acme import client
+    from .actions import Action
+
+# subcommand: (module, class, help)
+# Action modules are imported only when used, so each subcommand loads only what it needs.
+_ACTIONS = OrderedDict((
+    ('check', ('.actions', 'CheckAction', 'check installed files permissions and symlinks')),
+    ('revoke', ('.actions', 'RevokeAction', 'revoke certificates')),
+    ('auth', ('.actions', 'AuthAction', 'perform domain authentification')),
+    ('update', ('.update', 'UpdateAction', 'update keys, certificates, oscp, sct and params')),
+    ('verify', ('.actions', 'VerifyAction', 'verify installed certificates')),
+    ('cleanup', ('.actions', 'PruneAction', 'remove old archives')),
+    ('daemon', ('.daemon', 'Daemon', 'keep running and update certificates, ocsp and sct when they are due')),
+))
+
+
+def _action_class(name: str):
+    module, cls, _ = _ACTIONS[name]
+    return getattr(importlib.import_module(module, __package__), cls)
 
 
 class AcmeManager:
@@ -32,6 +53,18 @@ class AcmeManager:
         argparser.add_argument('-w', '--randomwait',
                                action='store_true', dest='random_wait', default=False,
                                help='Wait for a random time before executing')
+        argparser.add_argument('-j', '--jobs',
+                               type=int, dest='jobs', default=1, metavar='N',
+                               help='Number of certificates processed concurrently')
+        argparser.add_argument('--profile',
+                               action='store_true', dest='profile', default=False,
+                               help='Profile each phase, and print the hot functions')
+        argparser.add_argument('--profile-dir',
+                               default=None, dest='profile_dir', metavar='DIR',
+                               help='Save the profiles in DIR (implies --profile)')
+        argparser.add_argument('--trace',
+                               default=None, dest='trace', metavar='FILE',
+                               help='Save a timeline of the run in FILE (Chrome trace event format)')
 
         # Logging options
         argparser.add_argument('-q', '--quiet',  # error
@@ -53,27 +86,16 @@ class AcmeManager:
 
         subparsers = argparser.add_subparsers(description='acmetool subcommand', dest='action')
 
-        action = subparsers.add_parser('check', help='check installed files permissions and symlinks')
-        actions.CheckAction.add_arguments(action)
-
-        action = subparsers.add_parser('revoke', help='revoke certificates')
-        actions.RevokeAction.add_arguments(action)
-
-        action = subparsers.add_parser('auth', help='perform domain authentification')
-        actions.AuthAction.add_arguments(action)
-
-        action = subparsers.add_parser('update', help='update keys, certificates, oscp, sct and params')
-        UpdateAction.add_arguments(action)
-
-        action = subparsers.add_parser('verify', help='verify installed certificates')
-        actions.VerifyAction.add_arguments(action)
-
-        action = subparsers.add_parser('cleanup', help='remove old archives')
-        actions.PruneAction.add_arguments(action)
-
-        self.args = argparser.parse_args()
-        if not getattr(self.args, 'cls', None):
-            self.args = argparser.parse_args(sys.argv[1:] + ['update'])
+        # First find the requested subcommand, then add the arguments of this subcommand only.
+        parsers = {name: subparsers.add_parser(name, help=spec[2], add_help=False) for name, spec in _ACTIONS.items()}
+        argv = sys.argv[1:]
+        name = argparser.parse_known_args(argv)[0].action
+        if not name:
+            name = 'update'
+            argv = argv + [name]
+        parsers[name].add_argument('-h', '--help', action='help', help='show this help message and exit')
+        _action_class(name).add_arguments(parsers[name])
+        self.args = argparser.parse_args(argv)
 
         level = PROGRESS
         if self.args.quiet:
@@ -91,14 +113,23 @@ class AcmeManager:
         if not self.args.no_color:
             log.color = self.config.bool('color_output')
 
-    def connect_client(self) -> client.ClientV2:
+    def connect_client(self) -> 'client.ClientV2':
+        from . import acme
+
         account_dir = self.config.account_dir
         archive_dir = self.config.archive_dir('client')
-        with log.prefix('[acme] '):
+        # may be called while processing a certificate
+        with log.extra_fields(prefix='[acme] '):
             return acme.connect_client(account_dir, self.config.account['email'], self.config.get('acme_directory_url'),
-                                       self.config.account.get('passphrase'), archive_dir)
+                                       self.config.account.get('passphrase'), archive_dir, self.config.int('acme_directory_ttl'))
 
     def _run(self):
+        cls = self.args.cls
+        inventory = None
+        if cls.uses_inventory and self.config.bool('inventory'):
+            from .inventory import Inventory
+            inventory = Inventory.open(self.config.data_dir)
+
         certs = {}
         contexts = []
         for certificate_name in self.args.certificate_names or self.config.certificate_names():
@@ -113,30 +144,54 @@ class AcmeManager:
             if cert.name in certs:
                 log.info("requesting duplicated certificate (%s and %s)", certs[cert.name], certificate_name)
             else:
-                contexts.append(CertificateContext(cert, self.config.data_dir, self.config.path))
+                contexts.append(CertificateContext(cert, self.config.data_dir, self.config.path, inventory))
                 certs[cert.name] = certificate_name
 
         if not contexts:
             log.warning("nothing to process !")
             return (), ()
 
-        ok = []
-        errors = []
         acme_client = None
-        cls = self.args.cls
         if cls.has_acme_client:
-            acme_client = self.connect_client()
-        action = cls(self.config, self.args, contexts, acme_client)
-        for context in contexts:
-            try:
-                with log.prefix(f'[{context.name}] '):
-                    action.run(context)
-                ok.append(context.name)
-            except AcmeError as e:
-                log.error("[%s] processing failed. No files updated: %s", context.name, str(e), print_exc=True)
-                errors.append(context.name)
+            # connect only when needed
+            acme_client = LazyClient(self.connect_client)
+
+        if self.args.profile or self.args.profile_dir:
+            profiling.start(self.args.profile_dir)
+        if self.args.trace:
+            trace.start(self.args.trace)
+        if cls.exports_metrics and self.config.get('metrics_file'):
+            metrics.start()
+        try:
+            if 'daemon' == self.args.action:
+                return cls(self.config, self.args, contexts, acme_client, self.process).run()
+            return self.process(cls(self.config, self.args, contexts, acme_client), contexts)
+        finally:
+            if acme_client:
+                acme_client.close()
+            profiling.stop()
+            trace.stop()
+
+    def process(self, action: 'Action', contexts: List[CertificateContext]) -> Tuple[List[str], List[str]]:
+        started = time.time()
+        ok = []
+        errors = []
+        jobs = min(max(self.args.jobs, 1), len(contexts))
+        if jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            log.debug('processing %s certificates using %s workers', len(contexts), jobs)
+            with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='certmgr') as executor:
+                # buffer each certificate log, so concurrent outputs are not interleaved
+                results = list(executor.map(lambda ctx: _process_context(action, ctx, buffered=True), contexts))
+        else:
+            results = [_process_context(action, context) for context in contexts]
+
+        for context, success in zip(contexts, results):
+            (ok if success else errors).append(context.name)
+            metrics.record_certificate(context, success)
 
         action.finalize()
+        metrics.save(self.config.get('metrics_file'), started)
         return ok, errors
 
     def run(self) -> Tuple[List, List]:
@@ -172,6 +227,17 @@ class AcmeManager:
             return self._run()
 
 
+def _process_context(action: 'Action', context: CertificateContext, buffered: bool = False) -> bool:
+    with log.buffered() if buffered else contextlib.nullcontext():
+        try:
+            with log.prefix(f'[{context.name}] '), trace.span(context.name, 'context'), profiling.phase('run', context.name):
+                action.run(context)
+            return True
+        except AcmeError as e:
+            log.error("[%s] processing failed. No files updated: %s", context.name, str(e), print_exc=True)
+            return False
+
+
 def try_lock(lock_file) -> bool:
     try:
         fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
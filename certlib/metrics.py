@@ -0,0 +1,254 @@
+# Prometheus metrics (node exporter textfile collector format)
+#
+# Metrics are collected while processing the certificates, and written to the `metrics_file` once done
+# (after each batch when running as a daemon), so slow or stuck renewals can be alerted on without scraping the logs.
+import bisect
+import collections
+import contextlib
+import datetime
+import io
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .logging import log
+
+# network requests latency buckets (in seconds)
+_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = None  # type: Optional[_Registry]
+
+
+class _Summary:
+    __slots__ = ('count', 'sum', 'failures')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.failures = 0
+
+    def observe(self, seconds: float, success: bool = True):
+        self.count += 1
+        self.sum += seconds
+        if not success:
+            self.failures += 1
+
+
+class _Histogram(_Summary):
+    __slots__ = ('buckets',)
+
+    def __init__(self):
+        super().__init__()
+        self.buckets = [0] * len(_BUCKETS)
+
+    def observe(self, seconds: float, success: bool = True):
+        super().observe(seconds, success)
+        for index in range(bisect.bisect_left(_BUCKETS, seconds), len(_BUCKETS)):
+            self.buckets[index] += 1
+
+
+def _timestamp(value: Optional[datetime.datetime]) -> Optional[float]:
+    # certificates and OCSP dates are naive UTC dates
+    return value.replace(tzinfo=datetime.timezone.utc).timestamp() if value else None
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    values = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, values)) + '}'
+
+
+class _Writer:
+
+    def __init__(self):
+        self.out = io.StringIO()
+
+    def metric(self, name: str, kind: str, description: str, samples: List[Tuple[Dict[str, str], float]]):
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            return
+        self.out.write(f'# HELP {name} {description}\n# TYPE {name} {kind}\n')
+        for labels, value in samples:
+            self.out.write(f'{name}{_labels(labels)} {value}\n')
+
+    def summary(self, name: str, description: str, label: str, values: Dict[str, _Summary], histogram: bool = False,
+                failures: Optional[Tuple[str, str]] = None):
+        if not values:
+            return
+        self.out.write(f'# HELP {name} {description}\n# TYPE {name} {"histogram" if histogram else "summary"}\n')
+        for key, value in sorted(values.items()):
+            if histogram:
+                for bound, count in zip(_BUCKETS, value.buckets):
+                    self.out.write(f'{name}_bucket{_labels({label: key, "le": f"{bound:g}"})} {count}\n')
+                self.out.write(f'{name}_bucket{_labels({label: key, "le": "+Inf"})} {value.count}\n')
+            self.out.write(f'{name}_sum{_labels({label: key})} {value.sum}\n')
+            self.out.write(f'{name}_count{_labels({label: key})} {value.count}\n')
+        if failures:
+            self.metric(failures[0], 'counter', failures[1], [({label: key}, value.failures) for key, value in sorted(values.items())])
+
+
+class _Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = collections.defaultdict(_Histogram)  # type: Dict[str, _Histogram]
+        self._phases = collections.defaultdict(_Summary)  # type: Dict[str, _Summary]
+        self._hooks = collections.defaultdict(_Summary)  # type: Dict[str, _Summary]
+        self._reloads = collections.defaultdict(_Summary)  # type: Dict[str, _Summary]
+        # name -> success, and (name, key type) -> state
+        self._results = collections.OrderedDict()  # type: Dict[str, bool]
+        self._certificates = collections.OrderedDict()  # type: Dict[Tuple[str, str], dict]
+        self._run = None  # type: Optional[Tuple[float, float]]
+
+    def observe(self, values: Dict[str, _Summary], key: str, seconds: float, success: bool = True):
+        with self._lock:
+            values[key].observe(seconds, success)
+
+    def certificate(self, context, success: bool):
+        inventory = context.inventory
+        states = []
+        for item in context:
+            info = inventory.certificate_info(item) if inventory else None
+            certificate = info or item.certificate
+            state = {
+                'not_before': _timestamp(certificate.not_before) if certificate else None,
+                'not_after': _timestamp(certificate.not_after) if certificate else None,
+            }
+
+            dates = inventory.ocsp_dates(item) if inventory and context.config.ocsp_responder_urls else None
+            if dates is None and certificate and context.config.ocsp_responder_urls:
+                response = item.ocsp_response
+                if response and response.serial_number == certificate.serial_number:
+                    dates = response.this_update, response.next_update
+            state['ocsp_this_update'], state['ocsp_next_update'] = (_timestamp(dates[0]), _timestamp(dates[1])) if dates else (None, None)
+
+            scts = inventory.sct_timestamps(item) if inventory else None
+            if scts is None:
+                scts = {}
+                for ct_log in context.config.ct_submit_logs:
+                    sct_data, _ = item.sct(ct_log)
+                    if sct_data:
+                        scts[ct_log.name] = sct_data.timestamp
+            state['scts'] = {name: timestamp / 1000 for name, timestamp in scts.items()}
+            states.append(((item.name, item.type), state))
+
+        with self._lock:
+            self._results[context.name] = success
+            self._certificates.update(states)
+
+    def run(self, started: float):
+        with self._lock:
+            self._run = (time.time(), time.time() - started)
+
+    def render(self) -> str:
+        with self._lock:
+            writer = _Writer()
+            if self._run:
+                writer.metric('certmgr_last_run_timestamp_seconds', 'gauge', 'End time of the last run.', [({}, self._run[0])])
+                writer.metric('certmgr_last_run_duration_seconds', 'gauge', 'Duration of the last run.', [({}, self._run[1])])
+            writer.metric('certmgr_certificate_success', 'gauge', 'Whether the last processing of the certificate succeeded.',
+                          [({'certificate': name}, int(success)) for name, success in self._results.items()])
+
+            certificates = list(self._certificates.items())
+            for key, description in (('not_before', 'Start of the certificate validity period (last renewal).'),
+                                     ('not_after', 'End of the certificate validity period.'),
+                                     ('ocsp_this_update', 'Time at which the stored OCSP response was produced.'),
+                                     ('ocsp_next_update', 'Time at which the stored OCSP response expires.')):
+                writer.metric(f'certmgr_certificate_{key}_timestamp_seconds', 'gauge', description,
+                              [({'certificate': name, 'key_type': key_type}, state[key]) for (name, key_type), state in certificates])
+            writer.metric('certmgr_certificate_sct_timestamp_seconds', 'gauge', 'Timestamp of the stored Signed Certificate Timestamp.',
+                          [({'certificate': name, 'key_type': key_type, 'ct_log': ct_log}, timestamp)
+                           for (name, key_type), state in certificates for ct_log, timestamp in sorted(state['scts'].items())])
+
+            writer.summary('certmgr_phase_duration_seconds', 'Time spent in each processing phase.', 'phase', self._phases)
+            writer.summary('certmgr_request_duration_seconds', 'Network requests latency by endpoint.', 'endpoint', self._requests, histogram=True,
+                           failures=('certmgr_request_failures_total', 'Number of network requests which raised an error.'))
+            writer.summary('certmgr_hook_duration_seconds', 'Hooks execution time.', 'hook', self._hooks,
+                           failures=('certmgr_hook_failures_total', 'Number of failed hooks.'))
+            writer.summary('certmgr_service_reload_duration_seconds', 'Service reload commands execution time.', 'service', self._reloads,
+                           failures=('certmgr_service_reload_failures_total', 'Number of failed service reloads.'))
+            return writer.out.getvalue()
+
+
+def start():
+    """Enable metrics collection."""
+    global _registry
+    _registry = _Registry()
+
+
+def enabled() -> bool:
+    return _registry is not None
+
+
+@contextlib.contextmanager
+def _timed(registry: _Registry, values: Dict[str, _Summary], key: str):
+    start = time.perf_counter()
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        registry.observe(values, key, time.perf_counter() - start, success)
+
+
+def request(endpoint: str):
+    """Measure a network request to endpoint ('acme', 'ocsp', 'ct', 'dns' or 'http')."""
+    return _timed(_registry, _registry._requests, endpoint) if _registry else contextlib.nullcontext()
+
+
+def phase(name: str):
+    return _timed(_registry, _registry._phases, name) if _registry else contextlib.nullcontext()
+
+
+def record_phase(name: str, seconds: float):
+    if _registry:
+        _registry.observe(_registry._phases, name, seconds)
+
+
+def record_hook(name: str, seconds: float, success: bool):
+    if _registry:
+        _registry.observe(_registry._hooks, name, seconds, success)
+
+
+def record_reload(service: str, seconds: float, success: bool):
+    if _registry:
+        _registry.observe(_registry._reloads, service, seconds, success)
+
+
+def record_certificate(context, success: bool):
+    """Record the state of the certificate files once processed."""
+    if _registry:
+        try:
+            _registry.certificate(context, success)
+        except Exception as e:
+            log.warning("[%s] unable to collect metrics: %s", context.name, str(e))
+
+
+def save(path: str, started: float):
+    """Write the metrics file. started is the time (time.time()) the run started at."""
+    if not _registry:
+        return
+
+    _registry.run(started)
+    # the collector may read the file at any time: write a temporary file, and rename it over the previous one
+    directory = os.path.dirname(path) or '.'
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.metrics-', suffix='.tmp', dir=directory)
+    except OSError as e:
+        log.warning("unable to write metrics file '%s': %s", path, str(e))
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(_registry.render())
+            os.fchmod(f.fileno(), 0o644)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning("unable to write metrics file '%s': %s", path, str(e))
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
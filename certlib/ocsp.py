@@ -1,14 +1,27 @@
 import datetime
 import logging
-from typing import Optional, Union
+from typing import Optional, TYPE_CHECKING, Union
 
-import requests
-from asn1crypto import ocsp
+from . import metrics, trace
+
+# asn1crypto.ocsp is slow to import, and only needed when there is a response to parse
+if TYPE_CHECKING:
+    from asn1crypto import ocsp
+
+# used when a response does not tell when it will be updated
+_DEFAULT_VALIDITY = datetime.timedelta(days=1)
+
+
+def refresh_time(this_update: datetime.datetime, next_update: Optional[datetime.datetime]) -> datetime.datetime:
+    # refresh the response when half its validity period has elapsed
+    if not next_update:
+        next_update = this_update + _DEFAULT_VALIDITY
+    return this_update + (next_update - this_update) / 2
 
 
 class OCSP:
 
-    def __init__(self, response: ocsp.OCSPResponse):
+    def __init__(self, response: 'ocsp.OCSPResponse'):
         self.asn1 = response
 
     def encode(self) -> bytes:
@@ -16,6 +29,8 @@ class OCSP:
 
     @classmethod
     def decode(cls, ocsp_data):
+        from asn1crypto import ocsp
+
         return OCSP(ocsp.OCSPResponse.load(ocsp_data))
 
     @property
@@ -69,13 +84,16 @@ class OCSP:
 
     @staticmethod
     def fetch(ocsp_url, ocsp_request, last_update) -> Union[Optional['OCSP'], bool]:
+        import requests  # slow to import, and only needed here
+
         headers = {
             'Content-Type': 'application/ocsp-req',
             'Accept': 'application/ocsp-response'
         }
         if last_update:
             headers['If-Modified-Since'] = last_update.strftime('%a, %d %b %Y %H:%M:%S GMT')
-        req = requests.post(url=ocsp_url, headers=headers, data=ocsp_request.dump())
+        with metrics.request('ocsp'), trace.span('ocsp', 'http', url=ocsp_url):
+            req = requests.post(url=ocsp_url, headers=headers, data=ocsp_request.dump())
         try:
             if last_update and req.status_code == requests.codes.not_modified:
                 return False
@@ -0,0 +1,137 @@
+# Per phase profiling (--profile)
+#
+# Each phase is profiled separately, for each certificate. Nested phases pause the enclosing one, so a profile
+# only contains the time spent in its own phase. Phases are also reported to the metrics and the trace.
+import collections
+import contextlib
+import functools
+import io
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, TYPE_CHECKING, Tuple
+
+from . import metrics, trace
+from .logging import log
+
+# the profiler modules are only imported when profiling is enabled (--profile)
+if TYPE_CHECKING:
+    import cProfile
+
+# number of functions in the summary
+_TOP = 25
+
+_session = None  # type: Optional[_Session]
+
+
+class _Session:
+
+    def __init__(self, directory: Optional[str]):
+        import cProfile
+
+        self._profile_class = cProfile.Profile
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = collections.OrderedDict()  # type: Dict[Tuple[str, str], cProfile.Profile]
+        self._times = collections.OrderedDict()  # type: Dict[str, float]
+
+    def _stack(self) -> List[Tuple[str, 'cProfile.Profile']]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextlib.contextmanager
+    def phase(self, name: str, certificate: Optional[str]):
+        stack = self._stack()
+        if certificate is None:
+            certificate = stack[-1][0] if stack else ''
+        with self._lock:
+            profile = self._profiles.get((certificate, name))
+            if profile is None:
+                profile = self._profiles[(certificate, name)] = self._profile_class()
+
+        # only one profiler can be active in a thread
+        if stack:
+            stack[-1][1].disable()
+        stack.append((certificate, profile))
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1][1].enable()
+            with self._lock:
+                self._times[name] = self._times.get(name, 0) + elapsed
+            metrics.record_phase(name, elapsed)
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for (certificate, name), profile in self._profiles.items():
+            prefix = re.sub(r'[^\w.-]', '_', certificate or 'global')
+            profile.dump_stats(os.path.join(self.directory, f'{prefix}.{name}.prof'))
+        log.progress("%s profiles saved in '%s'", len(self._profiles), self.directory)
+
+    def summary(self) -> str:
+        out = io.StringIO()
+        out.write('Time per phase (all certificates):\n')
+        for name, elapsed in sorted(self._times.items(), key=lambda item: item[1], reverse=True):
+            out.write(f'  {elapsed:10.3f}s  {name}\n')
+        profiles = [profile for profile in self._profiles.values() if profile.getstats()]
+        if profiles:
+            import pstats
+
+            stats = pstats.Stats(*profiles, stream=out)
+            stats.sort_stats('tottime').print_stats(_TOP)
+        return out.getvalue()
+
+
+def start(directory: Optional[str] = None):
+    """Enable profiling. Profiles are saved in directory (if any) by stop()."""
+    global _session
+    _session = _Session(directory)
+
+
+def stop():
+    """Disable profiling, save the profiles and log a summary of the hot functions."""
+    global _session
+    session, _session = _session, None
+    if not session:
+        return
+    if session.directory:
+        session.save()
+    log.progress('%s', session.summary())
+
+
+def phase(name: str, certificate: Optional[str] = None):
+    """
+    Profile a phase. certificate defaults to the certificate of the enclosing phase.
+    Only measures the phase duration (for the metrics and the trace) if profiling is not enabled.
+    """
+    context = metrics.phase(name) if _session is None else _session.phase(name, certificate)
+    if trace.enabled():
+        return _traced(name, context)
+    return context
+
+
+@contextlib.contextmanager
+def _traced(name: str, context):
+    with trace.span(name, 'phase'), context:
+        yield
+
+
+def profiled(name: str):
+    """Decorator profiling each call of a function as a phase."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
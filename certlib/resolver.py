@@ -0,0 +1,219 @@
+# DNS lookups used by the dns-01 authorizations
+#
+# The CA checks the challenge records using any of the zone authoritative servers. Answering the challenge before all of them
+# serve the records results in an invalid authorization, so the records are first checked on each server.
+#
+# Zones which are not configured are discovered by looking for the SOA record of the name (or its closest ancestor).
+# Discovered zones are cached in memory and in a file (zone_cache), for the cache lifetime (or the SOA TTL if longer),
+# so the daily runs don't have to look them up again.
+import contextvars
+import json
+import threading
+import time
+from concurrent import futures
+from typing import Dict, List, Optional, Set, Tuple
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdatatype
+import dns.resolver
+
+from . import AcmeError, metrics, trace
+from .logging import log
+
+Server = Tuple[str, int]
+
+# per query timeout (in seconds)
+_QUERY_TIMEOUT = 5
+_MAX_CONCURRENT_QUERIES = 16
+
+_nameservers = {}  # type: Dict[str, List[Server]]
+_nameservers_lock = threading.Lock()
+
+# name -> (zone, expiration time)
+_zones = {}  # type: Dict[str, Tuple[str, float]]
+_zones_loaded = set()  # type: Set[str]
+_zones_lock = threading.Lock()
+
+
+def _resolve(name: str, rdtype: str) -> List[str]:
+    try:
+        with metrics.request('dns'), trace.span('resolve', 'dns', record=name, type=rdtype):
+            answer = dns.resolver.resolve(name, rdtype)
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        return []
+    return [rdata.to_text() for rdata in answer]
+
+
+def authoritative_servers(zone: str) -> List[Server]:
+    """Return the addresses of the zone authoritative name servers (IPv4 if available)."""
+    with _nameservers_lock:
+        servers = _nameservers.get(zone)
+    if servers is not None:
+        return servers
+
+    servers = []
+    try:
+        for nameserver in _resolve(zone, 'NS'):
+            addresses = _resolve(nameserver, 'A') or _resolve(nameserver, 'AAAA')
+            if not addresses:
+                log.warning("[%s] no address found for name server '%s'", zone, nameserver)
+            servers += [(address, 53) for address in addresses]
+    except dns.exception.DNSException as e:
+        log.raise_error("[%s] name servers lookup failed", zone, cause=e)
+
+    with _nameservers_lock:
+        _nameservers[zone] = servers
+    return servers
+
+
+def cname_targets(names: List[str]) -> Dict[str, Optional[str]]:
+    """Lookup the CNAME records of names, in parallel (name -> target, or None if name is not an alias)."""
+    def target(name: str) -> Optional[str]:
+        values = _resolve(name, 'CNAME')
+        return values[0].rstrip('.').lower() if values else None
+
+    names = list(dict.fromkeys(names))
+    if not names:
+        return {}
+    try:
+        with futures.ThreadPoolExecutor(max_workers=min(len(names), _MAX_CONCURRENT_QUERIES),
+                                        thread_name_prefix='certmgr-dns') as executor:
+            return dict(zip(names, executor.map(lambda name: contextvars.copy_context().run(target, name), names)))
+    except dns.exception.DNSException as e:
+        log.raise_error("CNAME lookup failed", cause=e)
+        raise  # silence flow analyzer warning
+
+
+def _soa_zone(name: str) -> Optional[Tuple[str, int]]:
+    """Return the zone containing name and its SOA TTL, or None if name does not exist."""
+    qname = dns.name.from_text(name)
+    try:
+        with metrics.request('dns'), trace.span('resolve', 'dns', record=name, type='SOA'):
+            answer = dns.resolver.resolve(qname, 'SOA', raise_on_no_answer=False)
+    except dns.resolver.NXDOMAIN:
+        return None
+    if answer.rrset is not None and answer.rrset.name == qname:
+        return name, answer.rrset.ttl
+    # not a zone apex: the negative answer contains the SOA of the enclosing zone
+    for rrset in answer.response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA and qname.is_subdomain(rrset.name):
+            return rrset.name.to_text(omit_final_dot=True), rrset.ttl
+    return None
+
+
+def _load_zones(path: str):
+    try:
+        with open(path) as f:
+            zones = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        log.warning("unable to load DNS zones cache '%s': %s", path, str(e))
+        return
+    now = time.time()
+    _zones.update({name: (zone, expires) for name, (zone, expires) in zones.items() if expires > now})
+
+
+def _save_zones(path: str):
+    from .utils import WriteOperation, commit_file_transactions
+
+    now = time.time()
+    with _zones_lock:
+        zones = {name: [zone, expires] for name, (zone, expires) in _zones.items() if expires > now}
+    op = WriteOperation(path, 0o644)
+    with op.file(binary=False) as f:
+        json.dump(zones, f, indent=2, sort_keys=True)
+    try:
+        commit_file_transactions([op])
+    except AcmeError:
+        log.warning("unable to write DNS zones cache '%s'", path)
+
+
+def _discover_zone(name: str, lifetime: int):
+    # walk up the name, as the name itself (and some of its parents) may not exist yet
+    candidate = name
+    result = None
+    try:
+        while candidate and not result:
+            result = _soa_zone(candidate)
+            candidate = candidate.partition('.')[2]
+    except dns.exception.DNSException as e:
+        log.raise_error("[%s] zone lookup failed", name, cause=e)
+    if not result:
+        log.raise_error("[%s] unable to find DNS zone, set 'zone' in the 'dns' auth", name)
+
+    zone, ttl = result
+    log.debug("[%s] found zone '%s'", name, zone)
+    with _zones_lock:
+        _zones[name] = (zone, time.time() + max(ttl, lifetime))
+
+
+def find_zones(names: List[str], cache: Optional[str] = None, lifetime: int = 3600) -> Dict[str, str]:
+    """
+    Return the zone of each name (name -> zone). Unknown zones are looked up in parallel, and saved in cache (if any)
+    for lifetime seconds (or the SOA TTL if longer).
+    """
+    now = time.time()
+    with _zones_lock:
+        if cache and cache not in _zones_loaded:
+            _zones_loaded.add(cache)
+            _load_zones(cache)
+        missing = {name.rstrip('.').lower() for name in names} - {name for name, (_, expires) in _zones.items() if expires > now}
+
+    if missing:
+        with futures.ThreadPoolExecutor(max_workers=min(len(missing), _MAX_CONCURRENT_QUERIES),
+                                        thread_name_prefix='certmgr-dns') as executor:
+            for future in [executor.submit(contextvars.copy_context().run, _discover_zone, name, lifetime) for name in sorted(missing)]:
+                future.result()
+        if cache:
+            _save_zones(cache)
+
+    with _zones_lock:
+        return {name: _zones[name.rstrip('.').lower()][0] for name in names}
+
+
+def query_txt(server: Server, name: str) -> Optional[Set[str]]:
+    """Return the TXT values of name served by server, or None if the server did not answer."""
+    query = dns.message.make_query(name, dns.rdatatype.TXT)
+    try:
+        with metrics.request('dns'), trace.span('query', 'dns', record=name, server=server[0]):
+            response = dns.query.udp(query, server[0], port=server[1], timeout=_QUERY_TIMEOUT)
+            if response.flags & dns.flags.TC:
+                response = dns.query.tcp(query, server[0], port=server[1], timeout=_QUERY_TIMEOUT)
+    except (dns.exception.DNSException, OSError) as e:
+        log.debug("[%s] query for '%s' failed: %s", server[0], name, str(e) or e.__class__.__name__)
+        return None
+
+    if response.rcode() != dns.rcode.NOERROR:
+        return set()
+    return {b''.join(rdata.strings).decode('ascii', 'replace')
+            for rrset in response.answer if rrset.rdtype == dns.rdatatype.TXT for rdata in rrset}
+
+
+def wait_for_txt(expected: Dict[Tuple[Server, str], Set[str]], timeout: float, delay: float) -> List[Tuple[Server, str]]:
+    """
+    Query the servers, in parallel, until each one serves the expected TXT values ((server, name) -> values).
+    Return the (server, name) which are still missing some values after timeout seconds.
+    """
+    pending = set(expected)
+    deadline = time.monotonic() + timeout
+    with futures.ThreadPoolExecutor(max_workers=min(max(len(pending), 1), _MAX_CONCURRENT_QUERIES),
+                                    thread_name_prefix='certmgr-dns') as executor:
+        while pending:
+            checks = {executor.submit(contextvars.copy_context().run, query_txt, server, name): (server, name)
+                      for server, name in pending}
+            for future, (server, name) in checks.items():
+                values = future.result()
+                if values is not None and expected[(server, name)] <= values:
+                    pending.discard((server, name))
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                break
+            log.debug('waiting for %s records to propagate', len(pending))
+            time.sleep(min(delay, remaining))
+    return sorted(pending)
@@ -1,12 +1,14 @@
 # SCT Support
 import base64
-from typing import List, NamedTuple, Optional
+from typing import List, NamedTuple, Optional, TYPE_CHECKING
 
-import requests
-
-from .crypto import Certificate
+from . import metrics, trace
 from .logging import log
 
+# cryptography is slow to import, and is not needed to parse the configuration
+if TYPE_CHECKING:
+    from .crypto import Certificate
+
 
 class SCTLog(NamedTuple):
     name: str
@@ -22,11 +24,14 @@ class SCTData(NamedTuple):
     signature: Optional[bytes]
 
 
-def fetch_sct(ct_log: SCTLog, certificate: Certificate, chain: List[Certificate]) -> SCTData:
+def fetch_sct(ct_log: SCTLog, certificate: 'Certificate', chain: List['Certificate']) -> SCTData:
     certificates = ([base64.b64encode(certificate.encode(pem=False)).decode('ascii')]
                     + [base64.b64encode(chain_certificate.encode(pem=False)).decode('ascii') for chain_certificate in chain])
 
-    req = requests.post(ct_log.url + '/ct/v1/add-chain', json={'chain': certificates})
+    import requests  # slow to import, and only needed here
+
+    with metrics.request('ct'), trace.span('ct', 'http', log=ct_log.name):
+        req = requests.post(ct_log.url + '/ct/v1/add-chain', json={'chain': certificates})
     try:
         if req.status_code == 200:
             sct = req.json()
@@ -0,0 +1,87 @@
+# Run timeline (--trace)
+#
+# Record nested spans using the Chrome trace event format, which can be viewed using Perfetto (https://ui.perfetto.dev)
+# or chrome://tracing. Each worker (--jobs) has its own track, so waiting tasks are easy to spot.
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .logging import log
+
+_tracer = None  # type: Optional[_Tracer]
+
+
+class _Tracer:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._events = []  # type: List[dict]
+        self._threads = {}  # type: Dict[int, str]
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, args: dict):
+        thread = threading.current_thread()
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = str(e) or e.__class__.__name__
+            raise
+        finally:
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                # microseconds
+                'ts': (start - self._origin) * 1e6,
+                'dur': (time.perf_counter() - start) * 1e6,
+                'pid': self._pid,
+                'tid': thread.ident,
+                'args': args,
+            }
+            with self._lock:
+                self._events.append(event)
+                self._threads.setdefault(thread.ident, thread.name)
+
+    def save(self):
+        with self._lock:
+            events = [{'name': 'process_name', 'ph': 'M', 'pid': self._pid, 'args': {'name': 'certmgr'}}]
+            events += [{'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid, 'args': {'name': name}}
+                       for tid, name in self._threads.items()]
+            events += sorted(self._events, key=lambda event: event['ts'])
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+            log.progress("trace saved in '%s' (%s spans)", self.path, len(events))
+        except OSError as e:
+            log.warning("unable to save trace '%s': %s", self.path, str(e))
+
+
+def start(path: str):
+    """Enable tracing. The trace is saved in path by stop()."""
+    global _tracer
+    _tracer = _Tracer(path)
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def stop():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer:
+        tracer.save()
+
+
+def span(name: str, category: str = '', **args):
+    """Record a span. args are shown in the span details. Does nothing if tracing is not enabled."""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, category, args)
@@ -1,35 +1,90 @@
 import argparse
+import contextvars
 import datetime
 import hashlib
 import json
 import os
+import socket
 import subprocess
+import threading
 import time
-from typing import List
+from concurrent import futures
+from typing import Dict, List, Optional, Set, TYPE_CHECKING, Tuple
 
-from acme import client
 from asn1crypto import ocsp
+from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 
-from . import AcmeError
+from . import AcmeError, metrics, profiling, trace
 from .actions import Action, prune_achives, update_links
-from .auth import authorize, authorize_noop
-from .config import Configuration
+from .config import Configuration, ServiceDef, ServiceProbe
 from .context import CertificateContext, CertificateItem
 from .crypto import PrivateKey, chain_has_issuer, fetch_dhparam, generate_dhparam, generate_ecparam, get_dhparam_size, get_ecparam_curve, load_full_chain
 from .logging import log
 from .ocsp import OCSP
+from .profiling import profiled
 from .sct import SCTLog, fetch_sct
-from .utils import ArchiveOperation, Hooks, commit_file_transactions
-from .verify import verify_certificate_installation
+from .utils import ArchiveOperation, Hooks, WriteOperation, commit_file_transactions
+
+# acme and dns are only needed to issue certificates, which most runs don't have to do.
+if TYPE_CHECKING:
+    from acme import client
+
+
+# maximum number of services reloaded (and probed) concurrently
+_MAX_CONCURRENT_RELOADS = 10
 
 
 def _sct_datetime(sct_timestamp):
     return datetime.datetime.utcfromtimestamp(sct_timestamp / 1000)
 
 
+def _served_serial_number(probe: ServiceProbe, host_name: str, timeout: float) -> int:
+    """Return the serial number of the certificate served for host_name (SNI)."""
+    import ssl  # only needed by the readiness probes
+
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    # the certificate is compared to the installed ones, not validated
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    with socket.create_connection((probe.host, probe.port), timeout=timeout) as sock:
+        if probe.starttls:
+            from .verify import send_starttls
+            send_starttls(probe.starttls, sock, host_name)
+            sock.settimeout(timeout)
+        with ssl_context.wrap_socket(sock, server_hostname=host_name) as ssl_sock:
+            der = ssl_sock.getpeercert(binary_form=True)
+    return x509.load_der_x509_certificate(der, default_backend()).serial_number
+
+
+def _check_ready(probe: ServiceProbe, pending: Dict[str, Set[int]], timeout: float) -> Optional[str]:
+    """Run the probe once, and return the reason the service is not ready, if any. Host names found ready are removed from pending."""
+    try:
+        if probe.command:
+            result = subprocess.run(probe.command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+            if result.returncode:
+                log.debug('readiness command output:\n%s', result.stdout)
+                return f'command returned {result.returncode}'
+            return None
+        if not pending:
+            socket.create_connection((probe.host, probe.port), timeout=timeout).close()
+            return None
+        for host_name, serial_numbers in list(pending.items()):
+            serial_number = _served_serial_number(probe, host_name, timeout)
+            if serial_number not in serial_numbers:
+                return f'"{host_name}" served certificate {serial_number:x} is not the installed one'
+            del pending[host_name]
+        return None
+    except subprocess.TimeoutExpired:
+        return 'command timed out'
+    except (OSError, AcmeError) as e:
+        return str(e) or e.__class__.__name__
+
+
 class UpdateAction(Action):
+    uses_inventory = True
+    exports_metrics = True
 
     @classmethod
     def add_arguments(cls, parser: argparse.ArgumentParser):
@@ -58,7 +113,7 @@ class UpdateAction(Action):
                             action='store_true', dest='no_auth', default=False,
                             help='Assume all domain names are already verified and do not perform any authorization')
 
-    def __init__(self, config: Configuration, args: argparse.Namespace, contexts: List[CertificateContext], acme_client: client.ClientV2):
+    def __init__(self, config: Configuration, args: argparse.Namespace, contexts: List[CertificateContext], acme_client: 'client.ClientV2'):
         if not args.certs and not args.params and not args.ocsp and not args.sct:
             args.certs = True
             args.params = True
@@ -67,6 +122,10 @@ class UpdateAction(Action):
         super().__init__(config, args, contexts, acme_client)
         self._done = []
         self._services = set()
+        # certificate name -> key type -> file kind -> change, passed to the files_updated hook
+        self._changes = {}  # type: Dict[str, Dict[str, Dict[str, dict]]]
+        # guards _done, _services and _changes when contexts are processed concurrently (--jobs)
+        self._lock = threading.Lock()
 
     def run(self, context: CertificateContext):
         if self.args.certs:
@@ -75,11 +134,17 @@ class UpdateAction(Action):
             self.process_params(context)
         if self.args.ocsp:
             self.update_ocsp(context)
+        sct_checked = False
         if self.args.sct:
-            self.update_signed_certificate_timestamps(context)
+            sct_checked = self.update_signed_certificate_timestamps(context)
 
         self.apply_changes(context)
-        self._done.append(context)
+        if context.inventory:
+            with profiling.phase('inventory'):
+                context.inventory.refresh(context, sct_checked)
+                context.inventory.commit()
+        with self._lock:
+            self._done.append(context)
         # Fixup links
         try:
             update_links(self.config.data_dir, context)
@@ -88,28 +153,33 @@ class UpdateAction(Action):
         # Cleanup Archives
         prune_achives(os.path.join(self.config.data_dir, 'archives', context.name), self.config.int('archive_days'))
 
+    @profiled('process_certificates')
     def process_certificates(self, context: CertificateContext):
         log.info('Update Certificates')
 
         # For each types, check if the cert exists and is valid (params match and not about to expire)
         for item in context:  # type: CertificateItem
-            with log.prefix(f'  - [{item.type.upper()}] '):
+            with log.prefix(f'  - [{item.type.upper()}] '), trace.span(item.type, 'item'):
                 if self.args.force or item.should_renew(self.config.int('renewal_days')):
+                    from .auth import authorize, authorize_noop
+
                     log.progress('Generating key')
-                    key = PrivateKey.create(item.type, item.params)
+                    with trace.span('generate_key', 'crypto'):
+                        key = PrivateKey.create(item.type, item.params)
 
                     log.debug('Requesting certificate for "%s" with alt names: "%s"', context.common_name, ', '.join(context.alt_names))
                     csr = key.create_csr(context.common_name, context.alt_names, context.config.ocsp_must_staple)
                     if self.args.no_auth:
-                        order = authorize_noop(csr, self.acme_client, Hooks(self.config.hooks))
+                        order = authorize_noop(csr, self.acme_client, Hooks(self.config.hooks, self.config.int('hooks_concurrency')))
                     else:
-                        order = authorize(csr, context, self.acme_client, Hooks(self.config.hooks))
+                        order = authorize(csr, context, self.acme_client, Hooks(self.config.hooks, self.config.int('hooks_concurrency')))
 
                     preferred_chain = context.config.preferred_chain
                     try:
-                        order = self.acme_client.finalize_order(order,
-                                                                datetime.datetime.now() + datetime.timedelta(seconds=self.config.int('cert_poll_time')),
-                                                                fetch_alternative_chains=bool(preferred_chain))
+                        with trace.span('finalize_order', 'acme'):
+                            order = self.acme_client.finalize_order(order,
+                                                                    datetime.datetime.now() + datetime.timedelta(seconds=self.config.int('cert_poll_time')),
+                                                                    fetch_alternative_chains=bool(preferred_chain))
                         certificate, chain = load_full_chain(order.fullchain_pem.encode('ascii'))
                         if not certificate or not chain:
                             log.raise_error("Certificate generation failed. Missing certificate or chain in response.")
@@ -130,6 +200,7 @@ class UpdateAction(Action):
 
                     log.progress('New certificate issued')
 
+    @profiled('process_params')
     def process_params(self, context: CertificateContext):
         log.info('Update DH and EC params')
 
@@ -140,6 +211,11 @@ class UpdateAction(Action):
             # Force refresh when certificates are updated
             force = self.args.force or context.updated
 
+            recorded = context.inventory.params(context) if context.inventory and not force else None
+            if recorded and recorded == (context.config.dhparam_size or 0, context.config.ecparam_curve or None):
+                log.debug("DH and EC up to date")
+                return
+
             # Updating dhparam
             dhparam = context.dhparam
             dhparam_size = context.config.dhparam_size
@@ -182,6 +258,7 @@ class UpdateAction(Action):
             else:
                 log.debug("DH and EC up to date")
 
+    @profiled('update_ocsp')
     def update_ocsp(self, context: CertificateContext):
         log.info('Update OCSP Response')
         for item in context:  # type: CertificateItem
@@ -190,7 +267,14 @@ class UpdateAction(Action):
                 item.ocsp_response = None
                 continue
 
-            with log.prefix(f'  - [{item.type.upper()}] '):
+            with log.prefix(f'  - [{item.type.upper()}] '), trace.span(item.type, 'item'):
+                # the inventory describes the installed certificate, not the one renewed by this run
+                use_inventory = context.inventory and not self.args.force and not context.updated and not item.certificate_updated
+                refresh_time = context.inventory.ocsp_refresh_time(item) if use_inventory else None
+                if refresh_time and datetime.datetime.utcnow() < refresh_time:
+                    log.debug('OCSP response up to date (refresh after %s)', refresh_time.strftime('%Y-%m-%d %H:%M:%S UTC'))
+                    continue
+
                 if not item.certificate:
                     log.warning("certificate not found. Can't update OCSP response")
                     continue
@@ -262,14 +346,22 @@ class UpdateAction(Action):
                 else:
                     log.warning('Unable to retrieve OCSP response')
 
-    def update_signed_certificate_timestamps(self, context: CertificateContext):
+    @profiled('update_signed_certificate_timestamps')
+    def update_signed_certificate_timestamps(self, context: CertificateContext) -> bool:
         if not context.config.ct_submit_logs:
-            return
+            return False
 
         log.info('Update Signed Certificate Timestamps')
 
+        if context.inventory and not self.args.force and not context.updated:
+            refresh_delay = datetime.timedelta(days=self.config.int('sct_refresh_days'))
+            checked = [context.inventory.sct_checked(item) for item in context]
+            if all(checked) and datetime.datetime.utcnow() < min(checked) + refresh_delay:
+                log.debug("SCTs up to date (checked at %s)", min(checked).strftime('%Y-%m-%d %H:%M:%S UTC'))
+                return False
+
         for item in context:  # type: CertificateItem
-            with log.prefix(f'  - [{item.type.upper()}] '):
+            with log.prefix(f'  - [{item.type.upper()}] '), trace.span(item.type, 'item'):
                 if not item.certificate:
                     log.warning('certificate not found')
                     continue
@@ -283,17 +375,25 @@ class UpdateAction(Action):
                             item.update_sct(ct_log, sct_data)
                         elif sct_data:
                             log.debug('[%s] SCT up to date (%s)', ct_log.name, _sct_datetime(sct_data.timestamp).isoformat())
+        return True
 
+    @profiled('apply_changes')
     def apply_changes(self, context: CertificateContext):
         # commit transaction, execute hooks, schedule service reload, …
         transactions = []
-        hooks = Hooks(self.config.hooks)
+        hooks = Hooks(self.config.hooks, self.config.int('hooks_concurrency'))
         owner = context.config.fileowner
+        # (key type, file kind, operation, written, existed), reported to the files_updated hook
+        changes = []  # type: List[Tuple[Optional[str], str, WriteOperation, bool, bool]]
+
+        def track(key_type: Optional[str], kind: str, op: WriteOperation):
+            transactions.append(op)
+            changes.append((key_type, kind, op, op.is_write, os.path.exists(op.file_path)))
 
         if context.params_updated:
             trx = context.save_params(owner)
             if trx:
-                transactions.append(trx)
+                track(None, 'params', trx)
                 if trx.is_write:
                     hooks.add('params_installed', certificate_name=context.name, file=trx.file_path)
                 # TODO: hooks('removed')
@@ -305,25 +405,25 @@ class UpdateAction(Action):
                 # archive existing file
                 path = item.certificate_path(full=True)
                 if path:
-                    transactions.append(ArchiveOperation('certificates', path))
+                    track(item.type, 'full_certificate', ArchiveOperation('certificates', path))
                     # TODO: hooks('removed')
 
             if item.certificate_updated or context.params_updated:
                 trx = item.save_certificate(owner)
                 if trx:
-                    transactions.append(trx)
+                    track(item.type, 'certificate', trx)
                     hooks.add('certificate_installed', certificate_name=item.name, key_type=item.type, file=trx.file_path)
 
                 if root:
                     trx = item.save_certificate(owner, root)
                     if trx:
-                        transactions.append(trx)
+                        track(item.type, 'full_certificate', trx)
                         hooks.add('full_certificate_installed', certificate_name=item.name, key_type=item.type, file=trx.file_path)
 
                 # Full Key
                 trx = item.save_key(owner, with_certificate=True)
                 if trx:
-                    transactions.append(trx)
+                    track(item.type, 'full_key', trx)
                     if trx.is_write:
                         hooks.add('full_key_installed', certificate_name=item.name, key_type=item.type, file=trx.file_path)
                     # TODO: hooks('removed')
@@ -331,67 +431,101 @@ class UpdateAction(Action):
             if item.certificate_updated:
                 trx = item.save_chain(owner)
                 if trx:
-                    transactions.append(trx)
+                    track(item.type, 'chain', trx)
                     hooks.add('chain_installed', certificate_name=item.name, key_type=item.type, file=trx.file_path)
 
                 trx = item.save_key(owner)
                 if trx:
-                    transactions.append(trx)
+                    track(item.type, 'private_key', trx)
                     # TODO: pass password to the hook ?
                     hooks.add('private_key_installed', certificate_name=item.name, key_type=item.type, file=trx.file_path)
             else:
-                if (not item.key.encrypted and item.config.private_key.passphrase) or (item.key.encrypted and not item.config.private_key.passphrase):
+                if item.key_encrypted != bool(item.config.private_key.passphrase):
                     log.info("Private key encryption configuration changed. Rewriting keys.")
                     # Replace existing file
                     op = item.save_key(owner, archive=False)
                     if op:
-                        transactions.append(op)
+                        track(item.type, 'private_key', op)
                         hooks.add('private_key_installed', certificate_name=item.name, key_type=item.type, file=op.file_path)
                     op = item.save_key(owner, archive=False, with_certificate=True)
                     if op:
-                        transactions.append(op)
+                        track(item.type, 'full_key', op)
                         hooks.add('full_key_installed', certificate_name=item.name, key_type=item.type, file=op.file_path)
 
             if item.ocsp_updated:
                 trx = item.save_ocsp(owner)
                 if trx:
-                    transactions.append(trx)
+                    track(item.type, 'ocsp', trx)
                     if trx.is_write:
                         hooks.add('ocsp_installed', certificate_name=item.name, key_type=item.type, file=trx.file_path)
                     # TODO: hooks('removed')
 
             for ct_log in item.config.ct_submit_logs:
-                sct_data, updated = item.sct(ct_log)
-                if not updated:
+                if not item.sct_updated(ct_log):
                     continue
                 trx = item.save_sct(ct_log, owner)
                 if trx:
-                    transactions.append(trx)
+                    track(item.type, f'sct.{ct_log.name}', trx)
                     hooks.add('sct_installed', certificate_name=item.name, key_type=item.type, file=trx.file_path, ct_log_name=ct_log.name)
         if transactions:
             commit_file_transactions(transactions, self.config.archive_dir(context.name))
+            self._record_changes(context, changes)
             services = context.config.services
             if services:
-                self._services.update(services)
+                with self._lock:
+                    self._services.update(services)
             hooks.call()
 
+    def _record_changes(self, context: CertificateContext, changes: List[Tuple[Optional[str], str, WriteOperation, bool, bool]]):
+        files = {}  # type: Dict[str, Dict[str, dict]]
+        for key_type, kind, op, written, existed in changes:
+            if not written and not existed:
+                continue
+            change = {'path': op.file_path}
+            if written:
+                change['action'] = 'written'
+                try:
+                    with open(op.file_path, 'rb') as f:
+                        change['sha256'] = hashlib.sha256(f.read()).hexdigest()
+                except OSError as e:
+                    log.warning("unable to read '%s': %s", op.file_path, str(e))
+            else:
+                change['action'] = 'archived' if getattr(op, 'archive_path', None) else 'removed'
+            kinds = files.setdefault(key_type or 'params', {})
+            # the full certificate is archived by a distinct operation before being written
+            archive = getattr(op, 'archive_path', None) or kinds.get(kind, {}).get('archive')
+            if archive:
+                change['archive'] = archive
+            kinds[kind] = change
+        if files:
+            with self._lock:
+                self._changes[context.name] = files
+
     def finalize(self):
         # Call hook usefull to sync status with other hosts
         updated = [context.name for context in self._done if context.updated]
         if updated:
-            hooks = Hooks(self.config.hooks)
+            hooks = Hooks(self.config.hooks, self.config.int('hooks_concurrency'))
             hooks.add('certificates_updated', certificates=json.dumps(sorted(updated)))
             hooks.call()
 
-        if self._reload_services() and self.args.verify:
-            log.info("Waiting service reload before verifying")
-            time.sleep(5)  # allow time for services to reload before verification
+        # a single call with all the files changes, so deployments can be done in one pass
+        if self._changes and self.config.hooks.get('files_updated'):
+            manifest = json.dumps({'data_dir': self.config.data_dir, 'certificates': self._changes}, indent=2, sort_keys=True)
+            for hook in self.config.hooks['files_updated']:
+                hook.execute(stdin=manifest.encode('utf-8'), certificates=json.dumps(sorted(self._changes)))
+
+        reloaded = self._reload_services()
+        if reloaded and self.args.verify:
+            self._wait_services(reloaded)
 
         # prune archives
         prune_achives(os.path.join(self.config.data_dir, 'archives', 'account'), self.config.int('archive_days'))
 
         # Verify is needed
         if self.args.verify:
+            from .verify import verify_certificate_installation
+
             for context in self._done:
                 with log.prefix(f"[{context.name}] "):
                     log.info("Verify certificates")
@@ -400,22 +534,83 @@ class UpdateAction(Action):
                     except AcmeError as e:
                         log.error("validation error: %s", str(e))
 
-    def _reload_services(self) -> bool:
-        reloaded = False
-        for service_name in self._services:
-            with log.prefix(f" - [{service_name}] "):
-                service_command = self.config.service(service_name)
-                if service_command:
-                    log.info('reloading service')
-                    try:
-                        output = subprocess.check_output(service_command, shell=True, stderr=subprocess.STDOUT)
-                        reloaded = True
-                        if output:
-                            log.info('reload OK with result:\n%s', output)
-                        else:
-                            log.debug('reload OK')
-                    except subprocess.CalledProcessError as e:
-                        log.warning('reload failed, code: %s:\n%s', e.returncode, e.output)
-                else:
+    @profiled('reload_services')
+    def _reload_services(self) -> List[ServiceDef]:
+        """Reload the services concurrently, and return the ones successfully reloaded."""
+        services = []
+        for service_name in sorted(self._services):
+            service = self.config.service(service_name)
+            if service:
+                services.append(service)
+            else:
+                with log.prefix(f" - [{service_name}] "):
                     log.error('no reload command registred')
-        return reloaded
+        if not services:
+            return []
+
+        with futures.ThreadPoolExecutor(max_workers=min(len(services), _MAX_CONCURRENT_RELOADS), thread_name_prefix='certmgr-reload') as executor:
+            results = [executor.submit(contextvars.copy_context().run, self._reload_service, service) for service in services]
+        return [service for service, future in zip(services, results) if future.result()]
+
+    @staticmethod
+    def _reload_service(service: ServiceDef) -> bool:
+        with log.prefix(f" - [{service.name}] "), trace.span(service.name, 'reload'):
+            log.info('reloading service')
+            start = time.perf_counter()
+            try:
+                output = subprocess.check_output(service.command, shell=True, stderr=subprocess.STDOUT, timeout=service.timeout)
+            except subprocess.CalledProcessError as e:
+                metrics.record_reload(service.name, time.perf_counter() - start, False)
+                log.warning('reload failed, code: %s:\n%s', e.returncode, e.output)
+                return False
+            except subprocess.TimeoutExpired:
+                metrics.record_reload(service.name, time.perf_counter() - start, False)
+                log.warning('reload timed out (%s seconds)', service.timeout)
+                return False
+            metrics.record_reload(service.name, time.perf_counter() - start, True)
+            if output:
+                log.info('reload OK with result:\n%s', output)
+            else:
+                log.debug('reload OK')
+            return True
+
+    @profiled('wait_services')
+    def _wait_services(self, services: List[ServiceDef]):
+        """Wait until the reloaded services are ready to be verified."""
+        log.info("Waiting service reload before verifying")
+        start = time.monotonic()
+        probed = [service for service in services if service.ready]
+        if probed:
+            with futures.ThreadPoolExecutor(max_workers=min(len(probed), _MAX_CONCURRENT_RELOADS), thread_name_prefix='certmgr-reload') as executor:
+                for future in [executor.submit(contextvars.copy_context().run, self._wait_ready, service) for service in probed]:
+                    future.result()
+        # no way to know when the other services are ready, give them their reload delay
+        delay = max((service.delay for service in services if not service.ready), default=0)
+        if delay > 0:
+            time.sleep(max(start + delay - time.monotonic(), 0))
+
+    def _wait_ready(self, service: ServiceDef) -> bool:
+        probe = service.ready
+        # host name -> serial numbers of the certificates the service must serve for it
+        pending = {}  # type: Dict[str, Set[int]]
+        if probe.port and probe.tls:
+            for context in self._done:
+                if service.name in (context.config.services or ()):
+                    serial_numbers = {item.certificate.serial_number for item in context if item.certificate}
+                    if serial_numbers:
+                        host_name = context.common_name
+                        pending['wildcard-test.' + host_name[2:] if host_name.startswith('*.') else host_name] = serial_numbers
+
+        deadline = time.monotonic() + probe.timeout
+        with log.prefix(f" - [{service.name}] "), trace.span(service.name, 'ready'):
+            while True:
+                error = _check_ready(probe, pending, max(deadline - time.monotonic(), 1))
+                if not error:
+                    log.info('service ready')
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.warning('service not ready after %s seconds: %s', probe.timeout, error)
+                    return False
+                log.debug('service not ready: %s', error)
+                time.sleep(min(probe.delay, remaining))
@@ -1,6 +1,9 @@
 import abc
+import collections
 import contextlib
+import contextvars
 import getpass
+import importlib
 import io
 import logging
 import os
@@ -8,9 +11,16 @@ import shlex
 import subprocess
 import sys
 import tempfile
-from typing import AnyStr, Dict, Iterable, List, NamedTuple, Optional, Tuple
+import threading
+import time
+from typing import Any, AnyStr, Callable, Dict, Iterable, List, NamedTuple, Optional, TYPE_CHECKING, Tuple, Union
 
+from . import AcmeError, metrics, trace
 from .logging import log
+from .profiling import profiled
+
+if TYPE_CHECKING:
+    from acme import client
 
 
 # ========= File System
@@ -30,6 +40,11 @@ def dirmode(mode: int) -> int:
     return mode
 
 
+# removedirs() prunes empty parent directories, which may be in use by an other worker (--jobs).
+# So directories creation and removal are serialized.
+_dirs_lock = threading.Lock()
+
+
 class Operation(metaclass=abc.ABCMeta):
 
     @abc.abstractmethod
@@ -71,24 +86,26 @@ class WriteOperation(Operation):
 
     def apply(self, archive_dir: Optional[str]):
         tmp_path = self.tmp_path(archive_dir)
-        try:
-            os.makedirs(os.path.dirname(tmp_path), dirmode(self.mode or 0o700))
-            self._rmdir = True
-        except FileExistsError:
-            pass
+        with _dirs_lock:
+            try:
+                os.makedirs(os.path.dirname(tmp_path), dirmode(self.mode or 0o700))
+                self._rmdir = True
+            except FileExistsError:
+                pass
 
-        # Move existing file out of the way
-        try:
-            os.rename(self.file_path, tmp_path)
-            self._tmp_path = tmp_path
-        except FileNotFoundError:
-            if self._rmdir:
-                os.removedirs(os.path.dirname(tmp_path))
+            # Move existing file out of the way
+            try:
+                os.rename(self.file_path, tmp_path)
+                self._tmp_path = tmp_path
+            except FileNotFoundError:
+                if self._rmdir:
+                    os.removedirs(os.path.dirname(tmp_path))
 
         if not self._content:
             return
 
-        os.makedirs(os.path.dirname(self.file_path), dirmode(self.mode), exist_ok=True)
+        with _dirs_lock:
+            os.makedirs(os.path.dirname(self.file_path), dirmode(self.mode), exist_ok=True)
         fmode = 'wb' if isinstance(self._content, bytes) else 'w'
         with open(self.file_path, fmode) as f:
             if self.mode:
@@ -126,7 +143,8 @@ class WriteOperation(Operation):
 
             if self._rmdir:
                 try:
-                    os.removedirs(os.path.dirname(self._tmp_path))
+                    with _dirs_lock:
+                        os.removedirs(os.path.dirname(self._tmp_path))
                 except (FileNotFoundError, OSError):
                     pass
 
@@ -153,6 +171,11 @@ class ArchiveAndWriteOperation(WriteOperation):
         if self._tmp_path and self._archived:
             log.debug("'%s' archived", self.file_path)
 
+    @property
+    def archive_path(self) -> Optional[str]:
+        """Path of the archived previous file, once applied."""
+        return self._tmp_path if self._archived else None
+
     def cleanup(self):
         # skip cleanup step if file archived (should not be removed)
         if self._archived:
@@ -169,6 +192,7 @@ class ArchiveOperation(ArchiveAndWriteOperation):
         raise NotImplementedError("archive operation does not support writing. Use ArchiveAndWriteOperation instead.")
 
 
+@profiled('commit_file_transactions')
 def commit_file_transactions(operations: Iterable[Operation], archive_dir: Optional[str] = None):
     if not operations:
         return
@@ -198,34 +222,120 @@ def commit_file_transactions(operations: Iterable[Operation], archive_dir: Optio
                 log.error("cleanup operation '%s' failed: %s", str(op), str(err))
 
 
+# ======= Plugins
+_plugins = {}  # type: Dict[Tuple[str, str], Any]
+# reentrant, as a plugin may load other plugins when imported
+_plugins_lock = threading.RLock()
+
+
+def load_plugin(spec: str, group: str) -> Any:
+    """
+    Return the object referenced by spec: either "module:attribute", or the name of an entry point of group.
+    Plugins are loaded once, so they can keep their state (sessions, credentials, …) for the whole run.
+    """
+    with _plugins_lock:
+        plugin = _plugins.get((group, spec))
+        if plugin is not None:
+            return plugin
+
+        module_name, sep, attribute = spec.partition(':')
+        try:
+            if sep:
+                plugin = importlib.import_module(module_name)
+                for name in attribute.split('.'):
+                    plugin = getattr(plugin, name)
+            else:
+                # slow to import, and only needed for entry points
+                from importlib import metadata
+                entry_points = metadata.entry_points()
+                if hasattr(entry_points, 'select'):
+                    matches = list(entry_points.select(group=group, name=spec))
+                else:  # python < 3.10
+                    matches = [entry_point for entry_point in entry_points.get(group, ()) if entry_point.name == spec]
+                if not matches:
+                    log.raise_error('[plugin:%s] no "%s" entry point found', spec, group)
+                plugin = matches[0].load()
+        except AcmeError:
+            raise
+        except Exception as e:
+            log.raise_error('[plugin:%s] loading failed', spec, cause=e)
+        _plugins[(group, spec)] = plugin
+        return plugin
+
+
 # ======= Hooks Management
 class Hook:
-    __slots__ = ('name', 'args', 'cwd', 'timeout')
+    __slots__ = ('name', 'args', 'plugin', 'cwd', 'timeout', 'ordered')
 
     def __init__(self, name, spec):
         self.name = name
         self.cwd = None
         self.timeout = None
+        # plugin: callable called in-process, instead of running a command
+        self.plugin = None  # type: Optional[str]
+        # ordered: calls of this hook must not run concurrently, and run in the order they are queued
+        self.ordered = False
         if isinstance(spec, str):
             self.args = shlex.split(spec)
         elif isinstance(spec, dict):
             self.args = spec.get('args')
+            self.plugin = spec.get('plugin')
             self.cwd = spec.get('cwd')
             self.timeout = spec.get('timeout', None)
+            self.ordered = bool(spec.get('ordered', False))
             # TODO: add support for env, …
         else:
             log.raise_error("[hook:%s] hook must be either a command line string, or a dictionary", name)
 
-        if not self.args:
+        if self.plugin:
+            if self.args:
+                log.raise_error("[hook:%s] a hook must have either arguments or a plugin, not both", name)
+            if not isinstance(self.plugin, str):
+                log.raise_error('[hook:%s] plugin must be a "module:callable" or an entry point name', name)
+        elif not self.args:
             log.raise_error("[hook:%s] arguments must not be empty", name)
 
-    def execute(self, **kwargs) -> bool:
-        args = None
+    def render(self, **kwargs) -> Optional[Union[List[str], Dict[str, Any]]]:
+        """
+        Return the hook command line, formatted using kwargs, or None if the hook specification is invalid.
+        Plugins get the fields as is.
+        """
+        if self.plugin:
+            return kwargs
+        try:
+            return [arg.format(**kwargs) for arg in self.args]
+        except KeyError as e:
+            log.warning('Invalid hook specification for "%s": unknown key {%s}', self.name, e)
+        except (IndexError, ValueError) as e:
+            log.warning('Invalid hook specification for "%s": %s', self.name, str(e))
+        return None
+
+    def execute(self, stdin: Optional[bytes] = None, **kwargs) -> bool:
+        """Run the hook, formatting its arguments using kwargs. stdin is sent to the hook standard input."""
+        args = self.render(**kwargs)
+        if args is None:
+            metrics.record_hook(self.name, 0, False)
+            return False
+        return self.run(args, stdin)
+
+    def key(self, args: Union[List[str], Dict[str, Any]]) -> tuple:
+        """Identify the calls doing the same thing."""
+        if self.plugin:
+            return (self.plugin, self.name, *sorted(args.items()))
+        return (self.cwd, *args)
+
+    def run(self, args: Union[List[str], Dict[str, Any]], stdin: Optional[bytes] = None) -> bool:
+        start = time.perf_counter()
+        with trace.span(self.name, 'hook'):
+            success = self._call_plugin(args, stdin) if self.plugin else self._run(args, stdin)
+        metrics.record_hook(self.name, time.perf_counter() - start, success)
+        return success
+
+    def _run(self, args: List[str], stdin: Optional[bytes]) -> bool:
         try:
-            args = [arg.format(**kwargs) for arg in self.args]
             log.progress('Calling hook %s: %s', self.name, args)
             # TODO: add support for env, …
-            output = subprocess.check_output(args, cwd=self.cwd, stderr=subprocess.STDOUT, shell=False, timeout=self.timeout)
+            output = subprocess.check_output(args, cwd=self.cwd, input=stdin, stderr=subprocess.STDOUT, shell=False, timeout=self.timeout)
             if output:
                 try:
                     output = output.decode('utf-8')
@@ -235,23 +345,36 @@ class Hook:
             else:
                 log.info("  OK")
             return True
-        except KeyError as e:
-            log.warning('Invalid hook specification for "%s": unknown key {%s}', self.name, e)
         except subprocess.CalledProcessError as e:
             log.warning('Hook %s returned error, code: %s:\n%s', self.name, e.returncode, e.output)
-        except TimeoutError as e:
-            log.warning("Timeout waiting Hook %s execution.")
+        except subprocess.TimeoutExpired:
+            log.warning('Timeout waiting Hook %s execution (%s seconds).', self.name, self.timeout)
         except Exception as e:
             log.warning('Failed to call hook %s (%s): %s', self.name, args, str(e))
         return False
 
+    def _call_plugin(self, fields: Dict[str, Any], stdin: Optional[bytes]) -> bool:
+        # plugins run in-process, so the timeout does not apply
+        try:
+            log.progress('Calling hook %s: %s', self.name, self.plugin)
+            result = load_plugin(self.plugin, 'certmgr.hooks')(self.name, stdin=stdin, **fields)
+        except Exception as e:
+            log.warning('Failed to call hook %s (%s): %s', self.name, self.plugin, str(e))
+            return False
+        if result is False:
+            log.warning('Hook %s returned error', self.name)
+            return False
+        log.info("  OK")
+        return True
+
 
 class Hooks:
-    __slots__ = ('_hooks', '_commands')
+    __slots__ = ('_hooks', '_commands', '_concurrency')
 
-    def __init__(self, commands: Dict[str, Optional[List[Hook]]]):
+    def __init__(self, commands: Dict[str, Optional[List[Hook]]], concurrency: int = 1):
         self._hooks: List[Tuple[List[Hook], Dict[str, str]]] = []
         self._commands: Dict[str, Optional[List[Hook]]] = commands
+        self._concurrency = concurrency
 
         # Hook Management
 
@@ -262,12 +385,36 @@ class Hooks:
 
         self._hooks.append((hooks, kwargs))
 
+    @profiled('hooks')
     def call(self):
+        # identical command lines are only run once
+        calls = collections.OrderedDict()  # type: Dict[tuple, Tuple[Hook, List[str]]]
         for hooks, kwargs in self._hooks:
             for hook in hooks:
-                hook.execute(**kwargs)
+                args = hook.render(**kwargs)
+                if args is not None:
+                    calls.setdefault(hook.key(args), (hook, args))
         self._clear_hooks()
 
+        if self._concurrency <= 1 or len(calls) <= 1:
+            for hook, args in calls.values():
+                hook.run(args)
+            return
+
+        # each queue runs sequentially. The calls of an ordered hook share a queue.
+        queues = collections.OrderedDict()  # type: Dict[object, List[Tuple[Hook, List[str]]]]
+        for key, (hook, args) in calls.items():
+            queues.setdefault(hook.name if hook.ordered else key, []).append((hook, args))
+
+        def run(queue: List[Tuple[Hook, List[str]]]):
+            for queued_hook, queued_args in queue:
+                queued_hook.run(queued_args)
+
+        from concurrent import futures
+        with futures.ThreadPoolExecutor(max_workers=min(len(queues), self._concurrency), thread_name_prefix='certmgr-hook') as executor:
+            for future in [executor.submit(contextvars.copy_context().run, run, queue) for queue in queues.values()]:
+                future.result()
+
     def _clear_hooks(self):
         self._hooks.clear()
 
@@ -278,14 +425,62 @@ class KeyCipherData(NamedTuple):
     forced: bool
 
 
+# concurrent workers must not prompt (or read stdin) at the same time
+_prompt_lock = threading.Lock()
+
+
 def get_key_cipher(name, passphrase, force_prompt) -> Optional[KeyCipherData]:
     forced = not bool(passphrase)
     if (passphrase is True) or (not passphrase and force_prompt):
         passphrase = os.getenv(f'{name.replace(".", "_").upper()}_PASSPHRASE')
         if not passphrase:
-            if sys.stdin.isatty():
-                passphrase = getpass.getpass(f'Enter private key password for {name}: ')
-            else:
-                passphrase = sys.stdin.readline().strip()
+            with _prompt_lock:
+                if sys.stdin.isatty():
+                    passphrase = getpass.getpass(f'Enter private key password for {name}: ')
+                else:
+                    passphrase = sys.stdin.readline().strip()
         # TODO: what to do if no passphrase at this point ?
     return KeyCipherData(passphrase.encode("utf-8"), forced) if passphrase else None
+
+
+class LazyClient:
+    """
+    ClientV2 proxy connecting to the ACME service the first time it is actually used.
+    Most runs don't have to issue anything, and so don't have to load the client key or fetch the directory.
+    """
+
+    def __init__(self, connect: Callable[[], 'client.ClientV2']):
+        self._connect = connect
+        self._client = None  # type: Optional[client.ClientV2]
+        self._error = None  # type: Optional[AcmeError]
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._client is not None
+
+    def clear_error(self):
+        """Allow a new connection attempt after a failure."""
+        self._error = None
+
+    def _get_client(self) -> 'client.ClientV2':
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    # don't retry (and prompt for the passphrase again) for each certificate
+                    if self._error:
+                        raise self._error
+                    try:
+                        self._client = self._connect()
+                    except AcmeError as e:
+                        self._error = e
+                        raise
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._get_client(), name)
+
+    def close(self):
+        save_nonces = getattr(self._client.net, 'save_nonces', None) if self._client is not None else None
+        if save_nonces:
+            save_nonces()
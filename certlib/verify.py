@@ -13,14 +13,16 @@ from dns import rdatatype
 from dns.resolver import Answer
 
 from certlib.config import VerifyTarget
+from . import metrics, trace
 from .config import VerifyDef
 from .context import CertificateContext, CertificateItem
 from .crypto import Certificate, chain_has_issuer
 from .logging import log
 from .ocsp import OCSP
+from .profiling import profiled
 
 
-def _send_starttls(ty: str, sock: socket.socket, host_name: str):
+def send_starttls(ty: str, sock: socket.socket, host_name: str):
     sock.settimeout(30)
     ty = ty.lower()
     if 'smtp' == ty:
@@ -82,7 +84,7 @@ def _fetch_tls_info(addr, ssl_context, host_name: str, starttls: Optional[str])
     sock.connect(addr[4])
 
     if starttls:
-        _send_starttls(starttls, sock, host_name)
+        send_starttls(starttls, sock, host_name)
 
     def _process_ocsp(conn: OpenSSL.SSL.Connection, ocsp_data, _):
         conn.set_app_data(OCSP.decode(ocsp_data) if ocsp_data else None)
@@ -106,7 +108,8 @@ def _fetch_tls_info(addr, ssl_context, host_name: str, starttls: Optional[str])
 
 def _lookup_tlsa_records(host, port, protocol='tcp') -> List[dns.rdtypes.ANY.TLSA.TLSA]:
     try:
-        answers: Answer = dns.resolver.query(f'_{port}._{protocol}.{host}.', rdatatype.TLSA)
+        with metrics.request('dns'), trace.span('tlsa', 'dns', host=host, port=port):
+            answers: Answer = dns.resolver.query(f'_{port}._{protocol}.{host}.', rdatatype.TLSA)
         return answers.rrset
     except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
         return []
@@ -281,6 +284,7 @@ def _verify_certificate_installation(item: CertificateItem, host_name: str, targ
                 log.error('Unable to connect: %s', str(error))
 
 
+@profiled('verify')
 def verify_certificate_installation(context: CertificateContext):
     verify = context.config.verify  # type: VerifyDef
     if not verify.targets:
@@ -0,0 +1,27 @@
+import unittest
+
+from certlib.config import AuthDef, DnsAuthDef, HookAuthDef
+
+
+class AuthInheritanceTest(unittest.TestCase):
+    def test_hook_inherits_default(self):
+        default = AuthDef.parse({'type': 'hook', 'command': 'default-hook', 'mode': 'parallel', 'timeout': 10})
+        auth = AuthDef.parse({'type': 'hook', 'command': 'certificate-hook'}, default)
+        self.assertIsInstance(auth, HookAuthDef)
+        self.assertEqual('parallel', auth.mode)
+        self.assertEqual(10, auth.cmd.timeout)
+
+    def test_dns_inherits_default(self):
+        default = AuthDef.parse({'type': 'dns', 'propagation_timeout': 120})
+        auth = AuthDef.parse({'type': 'dns', 'zone': 'example.com'}, default)
+        self.assertIsInstance(auth, DnsAuthDef)
+        self.assertEqual(120, auth.propagation_timeout)
+
+    def test_other_type_does_not_inherit(self):
+        default = AuthDef.parse({'type': 'hook', 'command': 'default-hook', 'mode': 'parallel', 'timeout': 10})
+        auth = AuthDef.parse({'type': 'dns'}, default)
+        self.assertEqual(0, auth.propagation_timeout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import socket
+import threading
+import unittest
+from typing import Dict, List
+from unittest import mock
+
+import dns.message
+import dns.rdatatype
+import dns.rrset
+
+from certlib import resolver
+
+
+class _DnsServer:
+    """Local UDP name server answering the TXT queries with records (name -> values)."""
+
+    def __init__(self, records: Dict[str, List[str]]):
+        self.records = records
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                data, peer = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            query = dns.message.from_wire(data)
+            response = dns.message.make_response(query)
+            question = query.question[0]
+            values = self.records.get(question.name.to_text(omit_final_dot=True))
+            if values and question.rdtype == dns.rdatatype.TXT:
+                response.answer.append(dns.rrset.from_text_list(question.name, 60, 'IN', 'TXT', [f'"{value}"' for value in values]))
+            self.sock.sendto(response.to_wire(), peer)
+
+    def close(self):
+        self.sock.close()
+
+
+class WaitForTxtTest(unittest.TestCase):
+    name = '_acme-challenge.example.com'
+
+    def setUp(self):
+        self.server = _DnsServer({self.name: ['validation']})
+        self.addCleanup(self.server.close)
+
+    def test_records_served(self):
+        self.assertEqual({'validation'}, resolver.query_txt(self.server.address, self.name))
+        self.assertEqual([], resolver.wait_for_txt({(self.server.address, self.name): {'validation'}}, 5, 0.1))
+
+    def test_records_never_served(self):
+        expected = {
+            (self.server.address, self.name): {'validation'},
+            (self.server.address, '_acme-challenge.www.example.com'): {'other'},
+        }
+        self.assertEqual([(self.server.address, '_acme-challenge.www.example.com')], resolver.wait_for_txt(expected, 0.3, 0.1))
+
+    def test_server_not_answering(self):
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+        self.addCleanup(silent.close)
+        address = silent.getsockname()
+        with mock.patch.object(resolver, '_QUERY_TIMEOUT', 0.2):
+            self.assertIsNone(resolver.query_txt(address, self.name))
+            self.assertEqual([(address, self.name)], resolver.wait_for_txt({(address, self.name): {'validation'}}, 0.3, 0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import hashlib
+import socket
+import ssl
+import unittest
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from certlib.auth.tls_alpn import _Responder, _validation_certificate
+
+_ID_PE_ACME_IDENTIFIER = x509.ObjectIdentifier('1.3.6.1.5.5.7.1.31')
+
+
+class TlsAlpnResponderTest(unittest.TestCase):
+    domain_name = 'www.example.com'
+    key_authorization = 'token.thumbprint'
+
+    def setUp(self):
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.responder = _Responder.acquire(('127.0.0.1', 0))
+        self.addCleanup(self.responder.release)
+        self.responder.add(self.domain_name, _validation_certificate(self.domain_name, self.key_authorization, key), key)
+
+    def _handshake(self, server_name: str) -> x509.Certificate:
+        """Connect the way the CA validator does, and return the certificate presented by the responder."""
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.set_alpn_protocols(['acme-tls/1'])
+        with socket.create_connection(self.responder.server.server_address, timeout=5) as sock, \
+                context.wrap_socket(sock, server_hostname=server_name) as ssl_sock:
+            self.assertEqual('acme-tls/1', ssl_sock.selected_alpn_protocol())
+            return x509.load_der_x509_certificate(ssl_sock.getpeercert(binary_form=True), default_backend())
+
+    def test_validation_certificate(self):
+        certificate = self._handshake(self.domain_name)
+        extension = certificate.extensions.get_extension_for_oid(_ID_PE_ACME_IDENTIFIER)
+        self.assertTrue(extension.critical)
+        digest = hashlib.sha256(self.key_authorization.encode('utf-8')).digest()
+        self.assertEqual(b'\x04\x20' + digest, extension.value.value)
+        san = certificate.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+        self.assertEqual([self.domain_name], san.value.get_values_for_type(x509.DNSName))
+
+    def test_unknown_server_name(self):
+        with self.assertRaises(ssl.SSLError):
+            self._handshake('unknown.example.com')
+
+
+if __name__ == '__main__':
+    unittest.main()
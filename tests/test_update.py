@@ -0,0 +1,77 @@
+import argparse
+import datetime
+import types
+import unittest
+from unittest import mock
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from certlib.update import UpdateAction
+
+
+def _issuer_certificate() -> x509.Certificate:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Test CA')])
+    now = datetime.datetime.utcnow()
+    return x509.CertificateBuilder() \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .public_key(key.public_key()) \
+        .serial_number(1) \
+        .not_valid_before(now) \
+        .not_valid_after(now + datetime.timedelta(days=1)) \
+        .sign(key, hashes.SHA256(), default_backend())
+
+
+class _Context(list):
+    def __init__(self, items, updated: bool):
+        super().__init__(items)
+        self.updated = updated
+        self.config = types.SimpleNamespace(ocsp_responder_urls=['http://ocsp.example.com'])
+        # the inventory still describes the previous certificate, which has an up to date OCSP response
+        self.inventory = mock.Mock()
+        self.inventory.ocsp_refresh_time.return_value = datetime.datetime.utcnow() + datetime.timedelta(days=3)
+
+
+class UpdateOcspTest(unittest.TestCase):
+    issuer = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.issuer = _issuer_certificate()
+
+    def _update_ocsp(self, certificate_updated: bool):
+        stale = types.SimpleNamespace(response_status='successful', serial_number=1,
+                                      this_update=datetime.datetime.utcnow() - datetime.timedelta(days=1))
+        item = types.SimpleNamespace(
+            type='rsa',
+            certificate=types.SimpleNamespace(serial_number=2, ocsp_urls=None),
+            certificate_updated=certificate_updated,
+            chain=[types.SimpleNamespace(x509_certificate=self.issuer)],
+            ocsp_response=stale,
+        )
+        fresh = types.SimpleNamespace(response_status='successful', cert_status='good', serial_number=2,
+                                      this_update=datetime.datetime.utcnow())
+        action = UpdateAction.__new__(UpdateAction)
+        action.args = argparse.Namespace(force=False)
+        with mock.patch('certlib.update.OCSP.fetch', return_value=fresh) as fetch:
+            action.update_ocsp(_Context([item], certificate_updated))
+        return item, fresh, fetch
+
+    def test_renewed_certificate_fetches_ocsp_response(self):
+        item, fresh, fetch = self._update_ocsp(certificate_updated=True)
+        fetch.assert_called_once()
+        self.assertIs(item.ocsp_response, fresh)
+
+    def test_unchanged_certificate_uses_inventory(self):
+        item, fresh, fetch = self._update_ocsp(certificate_updated=False)
+        fetch.assert_not_called()
+        self.assertIsNot(item.ocsp_response, fresh)
+
+
+if __name__ == '__main__':
+    unittest.main()